@@ -0,0 +1,16 @@
+import time
+import argparse
+
+import db
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="add the indexed paper_data.citation_valid column used to filter valid papers")
+    parser.add_argument('db_path', nargs='?', default='sqlite:///database.db')
+    args = parser.parse_args()
+
+    db.init_engine(args.db_path)
+    start = time.perf_counter()
+    if not db.ensure_validity_index():
+        raise SystemExit("cannot alter the database")
+    elapsed = time.perf_counter() - start
+    print(f"citation_valid indexed in {elapsed:.1f}s, {db.count_valid_papers()} valid papers")
@@ -1,41 +1,99 @@
 import json
-import queue
+import argparse
+from dataclasses import dataclass
+import numpy as np
 
 import db
 from db import Paper, Author, PaperData
 from visualize import gen_vertex, gen_edge
 
-def calc_vertex_in_num(E: list[dict[str, str]]) -> dict[str, int]:
-    res = {}
-    for edge in E:
-        if edge['target'] in res:
-            res[edge['target']] += 1
-        else:
-            res[edge['target']] = 1
-    return res
+@dataclass
+class Graph:
+    """
+    CSR adjacency, vertices are remapped to 0..len(ids)-1
+    the papers come first, then the cited ids which are not papers
+    out-neighbors of vertex v are indices[indptr[v]: indptr[v + 1]]
+    """
+    ids: list[str]
+    papers: int
+    indptr: np.ndarray
+    indices: np.ndarray
+
+    @staticmethod
+    def from_edges(V_id: list[str], E: list[dict[str, str]]) -> 'Graph':
+        ids = list(V_id)
+        index = {v: i for i, v in enumerate(ids)}
+        for edge in E:
+            if edge['target'] not in index:
+                index[edge['target']] = len(ids)
+                ids.append(edge['target'])
+        src = np.fromiter((index[edge['source']] for edge in E), dtype=np.int64, count=len(E))
+        dst = np.fromiter((index[edge['target']] for edge in E), dtype=np.int64, count=len(E))
+        order = np.argsort(src, kind='stable')
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=len(ids)), out=indptr[1:])
+        return Graph(ids, len(V_id), indptr, dst[order])
+
+    def edge_sources(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.ids)), np.diff(self.indptr))
+
+def calc_vertex_in_num(graph: Graph) -> np.ndarray:
+    return np.bincount(graph.indices, minlength=len(graph.ids))
 
-def mark_age(E: dict[str, list[str]], S: list[str]) -> dict[str, int]:
-    res = {}
-    q = queue.Queue()
-    for s in S:
-        q.put(s)
-        res[s] = 0
-    while not q.empty():
-        v = q.get()
-        for u in E.get(v, []):
-            if u not in res:
-                res[u] = res[v] + 1
-                q.put(u)
+def find_sources(graph: Graph) -> np.ndarray:
+    """
+    @return papers nobody cites
+    """
+    return np.flatnonzero(calc_vertex_in_num(graph)[: graph.papers] == 0)
+
+def mark_age(graph: Graph, S: np.ndarray) -> np.ndarray:
+    """
+    breadth-first distance from the nearest of `S`, one frontier array per level
+    @return age of every vertex, -1 if unreachable
+    """
+    res = np.full(len(graph.ids), -1, dtype=np.int64)
+    frontier = np.unique(np.asarray(S, dtype=np.int64))
+    res[frontier] = 0
+    level = 0
+    while frontier.size:
+        level += 1
+        starts = graph.indptr[frontier]
+        lens = graph.indptr[frontier + 1] - starts
+        # positions of all out-edges of the frontier in indices
+        offsets = np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+        nxt = graph.indices[offsets]
+        frontier = np.unique(nxt[res[nxt] < 0])
+        res[frontier] = level
     return res
 
-def calc_density(E: dict[str, list[str]], V: list[str], age: dict[str, int], thresh: int) -> float:
-    v = {v for v in V if age.get(v, 999) <= thresh}
-    e = 0
-    for u in v:
-        e += len([to for to in E[u] if to in v])
-    return e / (len(v) * (len(v) - 1))
+def calc_density(graph: Graph, age: np.ndarray, thresh: int) -> float:
+    inside = np.zeros(len(graph.ids), dtype=bool)
+    inside[: graph.papers] = (age[: graph.papers] >= 0) & (age[: graph.papers] <= thresh)
+    n = int(inside.sum())
+    e = int(np.count_nonzero(inside[graph.edge_sources()] & inside[graph.indices]))
+    return e / (n * (n - 1)) if n > 1 else 0.
+
+def density_by_age(graph: Graph, age: np.ndarray) -> np.ndarray:
+    """
+    calc_density for every threshold from 0 to the maximum age in one O(V + E) pass
+    papers are admitted by increasing age, and an edge is counted from the age its later end is admitted
+    """
+    levels = int(age.max()) + 1 if age.size else 0
+    paper_age = age.copy()
+    paper_age[graph.papers:] = -1
+    reached = paper_age >= 0
+    n = np.cumsum(np.bincount(paper_age[reached], minlength=levels))
+    src, dst = graph.edge_sources(), graph.indices
+    inside = reached[src] & reached[dst]
+    e = np.cumsum(np.bincount(np.maximum(paper_age[src[inside]], paper_age[dst[inside]]), minlength=levels))
+    pairs = n * (n - 1)
+    return np.divide(e, pairs, out=np.zeros(levels), where=pairs > 0)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="mark the age of papers in the citation graph")
+    parser.add_argument('--persist', action='store_true', help="save the title-matched targets to the database")
+    args = parser.parse_args()
+
     db.init_engine('sqlite:///../phocus/database.db') # new 573
     # db.init_engine('sqlite:///../phocus/database.3w.db')
     # db.init_engine('sqlite:///../phocus/database.bak0227.db') # 1w
@@ -43,13 +101,13 @@ if __name__ == '__main__':
     # db.init_engine('sqlite:///../Downloads/database.db') # 2.8w
     # db.init_engine('sqlite:///database.db')
     # db.init_engine('sqlite:///../Downloads/db0509.db') # 2.8w
-    papers = db.select_paper_all()
-    papers = [PaperData.from_Paper(paper) for paper in papers if paper.paper_citation.startswith("[true")]
+    columns = ('paper_title', 'author_list', 'paper_citation')
+    papers = list(db.iter_valid_paper_data(columns))
     
     V = gen_vertex(papers)
     V_id: list[str] = [v['id'] for v in V]
     print(f"{len(V)} valid papers")
-    E = gen_edge(papers, V)
+    E = gen_edge(papers, V, persist=args.persist)
     print(f"{len(E)} valid references")
     
     # E: list[dict[str, str]]
@@ -59,17 +117,14 @@ if __name__ == '__main__':
         'target': str(target_id),
     }
     '''
-    vertex_in_num = calc_vertex_in_num(E)
-    source = [v for v in V_id if v not in vertex_in_num]
-    
-    E_per_v: dict[str, list[str]] = {v: [] for v in V_id}
-    for edge in E:
-        E_per_v[edge['source']].append(edge['target'])
+    graph = Graph.from_edges(V_id, E)
+    source = find_sources(graph)
     
-    age = mark_age(E_per_v, source)
+    ages = mark_age(graph, source)
+    age = {graph.ids[v]: int(ages[v]) for v in np.flatnonzero(ages >= 0)}
     json.dump(age, open('age.json', 'w'), indent=4)
     json.dump(V_id, open('V_id.json', 'w'), indent=4)
     # assert len(age) == len(V_id), f"{len(age)} != {len(V_id)}"
     
-    for age_max in range(max(age.values()) + 1):
-        print(f"age: {age_max}, density: {calc_density(E_per_v, V_id, age, age_max)}")
+    for age_max, density in enumerate(density_by_age(graph, ages)):
+        print(f"age: {age_max}, density: {density}")
@@ -0,0 +1,16 @@
+import time
+import argparse
+
+import db
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="build the normalized citation table from paper_data.paper_citation")
+    parser.add_argument('db_path', nargs='?', default='sqlite:///database.db')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    db.init_engine(args.db_path)
+    start = time.perf_counter()
+    rows = db.backfill_citations(args.batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"{rows} citations of {db.count_valid_papers()} papers in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
@@ -1,44 +1,142 @@
+import os
+import math
 import json
 import glob
-from multiprocessing import Pool, Queue
+import argparse
+from functools import partial
+from multiprocessing import Pool
 from tqdm import tqdm
 from loguru import logger
+from PyPDF2 import PdfReader
 
-from deal_pdf import deal, ResultIntegrity, NumberedIntegrity, UnnumberedIntegrity
+from deal_pdf import deal, ResultIntegrity, NumberedIntegrity, UnnumberedIntegrity, StageStat
 
-def work(fname: str) -> tuple[str, str, ResultIntegrity|Exception]:
+WorkResult = tuple[str, str, ResultIntegrity|Exception, list[StageStat]]
+
+def work(fname: str, trace_memory: bool = False) -> WorkResult:
+    stages: list[StageStat] = [] # filled by deal, partially if it raises
     try:
-        result = deal(fname)
+        result = deal(fname, trace_memory=trace_memory, stats=stages)
         integrity = result.integrity()
         if isinstance(integrity, NumberedIntegrity):
             success_ratio = len(integrity.ok_labels) / (integrity.num_range[1] - integrity.num_range[0])
             if success_ratio > 0.5:
-                return fname, 'OK', integrity
+                return fname, 'OK', integrity, stages
             else:
-                return fname, 'SUC_LOW', integrity
+                return fname, 'SUC_LOW', integrity, stages
         elif isinstance(integrity, UnnumberedIntegrity):
             if len(integrity.ok_labels) > 4:
-                return fname, 'OK', integrity
+                return fname, 'OK', integrity, stages
             else:
-                return fname, 'NO_LABEL', integrity
+                return fname, 'NO_LABEL', integrity, stages
         else:
             raise Exception('Unknown integrity type')
     except Exception as e:
-        return fname, 'Exception', e
+        return fname, 'Exception', e, stages
+
+def work_chunk(fnames: list[str], trace_memory: bool = False) -> list[WorkResult]:
+    return [work(fname, trace_memory) for fname in fnames]
+
+def percentile(values: list[float], q: float) -> float:
+    """
+    nearest-rank percentile, `values` must be sorted
+    """
+    if not values:
+        return 0.
+    idx = min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))
+    return values[idx]
+
+def stage_report(all_stages: dict[str, list[StageStat]], qs: tuple[int, ...] = (50, 90, 99)) -> dict[str, dict]:
+    """
+    aggregate per-file stage stats into per-stage percentiles
+    @param all_stages: file name -> stage stats of the file
+    """
+    by_stage: dict[str, list[StageStat]] = {}
+    for stages in all_stages.values():
+        for stat in stages:
+            by_stage.setdefault(stat.name, []).append(stat)
+    report: dict[str, dict] = {}
+    for name, stats in by_stage.items():
+        entry: dict = {'count': len(stats)}
+        for metric in ('wall', 'cpu', 'mem_peak', 'rss_delta'):
+            values = sorted(getattr(stat, metric) for stat in stats)
+            entry[metric] = {f'p{q}': percentile(values, q) for q in qs}
+            entry[metric]['max'] = values[-1]
+            entry[metric]['sum'] = sum(values)
+        report[name] = entry
+    return report
+
+def log_stage_report(report: dict[str, dict]) -> None:
+    total = sum(entry['wall']['sum'] for entry in report.values()) or 1.
+    for name, entry in sorted(report.items(), key=lambda x: -x[1]['wall']['sum']):
+        wall = entry['wall']
+        logger.info(
+            f"{name:<24} {wall['sum'] / total:6.1%} of wall | "
+            f"p50 {wall['p50']:.3f}s p90 {wall['p90']:.3f}s p99 {wall['p99']:.3f}s max {wall['max']:.3f}s | "
+            f"cpu p50 {entry['cpu']['p50']:.3f}s | mem p90 {entry['mem_peak']['p90'] / 2**20:.1f}MB"
+        )
+
+def estimate_cost(fname: str) -> float:
+    """
+    cheap estimation of how long `deal` takes on the file
+    page count dominates layout analysis, byte size accounts for heavy figures
+    """
+    size = os.path.getsize(fname)
+    try:
+        pages = len(PdfReader(fname).pages)
+    except Exception:
+        pages = size / 50_000 # roughly 50KB per page
+    return pages + size / 200_000
+
+def plan_tasks(files: list[str], workers: int, chunk_cost: float = 0.) -> list[list[str]]:
+    """
+    sort files longest-first and pack the small ones into chunks
+    a chunk is closed once its cost reaches `chunk_cost`,
+    which defaults to a fraction of the average load per worker
+    so that the tail of the run is still balanced
+    """
+    costs = {fname: estimate_cost(fname) for fname in files}
+    ordered = sorted(files, key=lambda f: costs[f], reverse=True)
+    if chunk_cost <= 0:
+        chunk_cost = sum(costs.values()) / max(workers, 1) / 8
+    chunks: list[list[str]] = []
+    current: list[str] = []
+    current_cost = 0.
+    for fname in ordered:
+        current.append(fname)
+        current_cost += costs[fname]
+        if current_cost >= chunk_cost:
+            chunks.append(current)
+            current, current_cost = [], 0.
+    if current:
+        chunks.append(current)
+    return chunks
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="run deal on every PDF of test_pdf/")
+    parser.add_argument('--trace-memory', action='store_true', help="measure the memory peak of each stage by tracemalloc (slower)")
+    args = parser.parse_args()
+
     files = glob.glob('test_pdf/*.pdf')
-    q = Queue()
-    pool = Pool(16)
-    _ = [pool.apply_async(work, (fname, ), callback=lambda x: q.put(x)) for fname in files]
-    
+    workers = 16
+    chunks = plan_tasks(files, workers)
+    logger.info(f"{len(files)} files in {len(chunks)} tasks")
+
     total: dict[str, list[tuple[str, str]]] = {
         'OK': [],
         'SUC_LOW': [],
         'NO_LABEL': [],
         'Exception': [],
     }
-    for _ in tqdm(range(len(files))):
-        fname, status, result = q.get()
-        total[status].append((fname, str(result)))
-        json.dump(total, open('result.json', 'w'), indent=4)
\ No newline at end of file
+    all_stages: dict[str, list[StageStat]] = {}
+    with Pool(workers) as pool, tqdm(total=len(files)) as bar:
+        for results in pool.imap_unordered(partial(work_chunk, trace_memory=args.trace_memory), chunks):
+            for fname, status, result, stages in results:
+                total[status].append((fname, str(result)))
+                all_stages[fname] = stages
+            bar.update(len(results))
+            json.dump(total, open('result.json', 'w'), indent=4)
+
+    report = stage_report(all_stages)
+    json.dump(report, open('stages.json', 'w'), indent=4)
+    log_stage_report(report)
@@ -0,0 +1,145 @@
+"""
+ingest a corpus of arXiv LaTeX sources in parallel
+every source is a directory, a tarball or a single gzipped .tex file,
+one JSON line is written per source, sources which succeeded are skipped on resume,
+failed ones are tried again and the last line of a source wins
+"""
+import os
+import gzip
+import json
+import glob
+import tarfile
+import argparse
+from multiprocessing import Pool
+from tqdm import tqdm
+from loguru import logger
+
+from pylatexenc.latex2text import LatexNodes2Text
+
+from main import get_citations, get_bibitems, assign_citations, find_thebibliography
+
+TEX_EXTS = ('.tex', '.bbl')
+
+def source_id(path: str) -> str:
+    name = os.path.basename(path.rstrip('/'))
+    for ext in ('.tar.gz', '.tgz', '.tar', '.gz'):
+        if name.endswith(ext):
+            return name[: -len(ext)]
+    return name
+
+def read_source(path: str) -> tuple[list[str], list[str]]:
+    """
+    @return (tex files, bbl files) contents of the source
+    """
+    files: list[tuple[str, str]] = []
+    def decode(raw: bytes) -> str:
+        return raw.decode('utf-8', errors='ignore')
+    if os.path.isdir(path):
+        for fname in sorted(glob.glob(os.path.join(path, '**', '*'), recursive=True)):
+            if fname.endswith(TEX_EXTS):
+                with open(fname, 'rb') as f:
+                    files.append((fname, decode(f.read())))
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(TEX_EXTS):
+                    fobj = tar.extractfile(member)
+                    assert fobj is not None
+                    files.append((member.name, decode(fobj.read())))
+    elif path.endswith('.gz'): # arXiv ships single-file sources as plain gzip
+        with gzip.open(path, 'rb') as f:
+            files.append(('main.tex', decode(f.read())))
+    else:
+        with open(path, 'rb') as f:
+            files.append((path, decode(f.read())))
+    files.sort()
+    texes = [s for name, s in files if name.endswith('.tex')]
+    bbls = [s for name, s in files if name.endswith('.bbl')]
+    return texes, bbls
+
+def work(path: str) -> dict:
+    record: dict = {'id': source_id(path), 'path': path}
+    try:
+        texes, bbls = read_source(path)
+        doc = '\n\n'.join(texes)
+        converter = LatexNodes2Text()
+        citations = get_citations(doc, converter)
+        has_thebibliography = find_thebibliography(doc) is not None
+        bibitems = {}
+        if not has_thebibliography and not bbls: # skips the slow full parse of get_bibitems
+            record['bib_error'] = repr(Exception("No thebibliography found"))
+        else:
+            try:
+                bibitems = get_bibitems(doc if has_thebibliography else '\n\n'.join(bbls), converter)
+            except Exception as e:
+                bibitems = {}
+                record['bib_error'] = repr(e)
+        assign_citations(citations, bibitems)
+        record['bibitems'] = {key: bib.s for key, bib in bibitems.items()}
+        record['citations'] = [{
+            'keys': citation.keys,
+            'context': citation.context.text,
+            'start': citation.context.start,
+            'end': citation.context.end,
+            'resolved': [key for key in citation.keys if key in citation.bibitems],
+        } for citation in citations]
+    except Exception as e:
+        record['error'] = repr(e)
+    return record
+
+def finished_ids(output: str) -> set[str]:
+    """
+    @return ids of the sources whose last record has no error
+    """
+    done: set[str] = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                if 'error' in record:
+                    done.discard(record['id'])
+                else:
+                    done.add(record['id'])
+            except (json.JSONDecodeError, KeyError):
+                pass # a line cut off by an interrupted run
+    return done
+
+def list_sources(roots: list[str]) -> list[str]:
+    """
+    a root is either a source itself or a directory of sources
+    """
+    sources: list[str] = []
+    for root in roots:
+        if os.path.isdir(root) and not glob.glob(os.path.join(root, '*.tex')):
+            sources.extend(sorted(os.path.join(root, name) for name in os.listdir(root)))
+        else:
+            sources.append(root)
+    return sources
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="extract citations from a corpus of LaTeX sources")
+    parser.add_argument('roots', nargs='+', help="source directories/tarballs, or directories of them")
+    parser.add_argument('--output', default='latex_citations.jsonl')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunksize', type=int, default=4)
+    args = parser.parse_args()
+
+    done = finished_ids(args.output)
+    sources = [s for s in list_sources(args.roots) if source_id(s) not in done]
+    logger.info(f"{len(sources)} sources to process, {len(done)} already done")
+
+    if os.path.exists(args.output) and os.path.getsize(args.output) > 0:
+        with open(args.output, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n': # terminate the line cut off by an interrupted run
+                f.write(b'\n')
+
+    failed = 0
+    with Pool(args.workers, maxtasksperchild=256) as pool, open(args.output, 'a') as out:
+        for record in tqdm(pool.imap_unordered(work, sources, chunksize=args.chunksize), total=len(sources)):
+            failed += 'error' in record
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+    logger.success(f"Done, {failed} failed")
@@ -0,0 +1,92 @@
+"""
+concurrent read throughput and write latency of a SQLite database,
+with the default engine and with init_engine(tuned=True)
+"""
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing as mp
+
+import db
+from db import Paper, ModelBase
+
+def make_db(path: str, n: int) -> None:
+    db.init_engine(f"sqlite:///{path}")
+    ModelBase.metadata.create_all(db.engine, tables=[Paper.__table__]) # type: ignore
+    rows = [{
+        'paper_id': i,
+        'paper_title': f"Paper {i}",
+        'website_url': f"https://example.org/{i}",
+        'author_list': json.dumps([True, [f"Author {i}"]]),
+        'paper_citation': json.dumps([True, [["", f"Bibitem {j}", -1, ""] for j in range(30)]]),
+        'paper_year': json.dumps([True, "2020"]),
+    } for i in range(1, n + 1)]
+    with db.engine.begin() as conn: # type: ignore
+        conn.execute(db.insert(Paper), rows)
+
+def reader(path: str, tuned: bool, n: int, seconds: float, counter) -> None:
+    db.init_engine(f"sqlite:///{path}", tuned=tuned)
+    rng = random.Random(os.getpid())
+    reads = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            assert db.select_paper_by_id(rng.randint(1, n))
+            reads += 1
+        except Exception:
+            pass # locked
+    with counter.get_lock():
+        counter.value += reads
+
+def run(path: str, tuned: bool, n: int, readers: int, seconds: float) -> dict:
+    counter = mp.Value('i', 0)
+    procs = [mp.Process(target=reader, args=(path, tuned, n, seconds, counter)) for _ in range(readers)]
+    for p in procs:
+        p.start()
+    db.init_engine(f"sqlite:///{path}", tuned=tuned)
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + seconds
+    rng = random.Random(0)
+    while time.perf_counter() < deadline:
+        ids = rng.sample(range(1, n + 1), 50)
+        start = time.perf_counter()
+        try:
+            db.update_papers((i, 'paper_title', f"Paper {i} v{start}") for i in ids)
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors += 1
+        time.sleep(0.01)
+    for p in procs:
+        p.join()
+    latencies.sort()
+    return {
+        'reads_per_s': counter.value / seconds,
+        'write_p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else float('nan'),
+        'write_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float('nan'),
+        'write_errors': errors,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20000, help="papers in the test database")
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmp, 'base.db')
+        make_db(base, args.n)
+        for tuned in (False, True):
+            path = os.path.join(tmp, f"bench_{tuned}.db")
+            shutil.copy(base, path)
+            res = run(path, tuned, args.n, args.readers, args.seconds)
+            print(f"{'tuned' if tuned else 'default':>8}: {res['reads_per_s']:.0f} reads/s, "
+                  f"write p50 {res['write_p50_ms']:.1f}ms p99 {res['write_p99_ms']:.1f}ms, {res['write_errors']} failed writes")
+    finally:
+        shutil.rmtree(tmp)
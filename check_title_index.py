@@ -0,0 +1,39 @@
+import time
+import argparse
+
+import db
+from title_index import TitleIndex, normalize_title
+from visualize import bibitem_sentences, find_target
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="check that the title index resolves citations like comparing with every title")
+    parser.add_argument('db_path', nargs='?', default='sqlite:///database.db')
+    parser.add_argument('--limit', type=int, default=2000, help="number of citations to check")
+    args = parser.parse_args()
+
+    db.init_engine(args.db_path)
+    papers = list(db.iter_valid_paper_data(('paper_title', 'paper_citation')))
+    index = TitleIndex.from_papers(papers)
+    bibitems = [cite[1] for paper in papers for cite in paper.paper_citation[1]][:args.limit]
+
+    start = time.perf_counter()
+    expected = [find_target(bibitem, papers) for bibitem in bibitems]
+    scan_time = time.perf_counter() - start
+    start = time.perf_counter()
+    found = [find_target(bibitem, papers, index) for bibitem in bibitems]
+    index_time = time.perf_counter() - start
+
+    missed = differ = 0
+    for bibitem, a, b in zip(bibitems, expected, found):
+        if a == b:
+            continue
+        # a title equal up to case and punctuation may score below the threshold, or come after a fuzzy match
+        if any(normalize_title(sentence) in index.exact for sentence in bibitem_sentences(bibitem)):
+            differ += 1
+            continue
+        missed += 1
+        print(f"expected {a}, found {b}: {bibitem!r}")
+    print(f"{len(bibitems)} citations in {scan_time:.1f}s by scan, {index_time:.1f}s by index, "
+          f"{differ} resolved differently by exact lookup, {missed} mismatched")
+    if missed:
+        raise SystemExit(1)
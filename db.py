@@ -1,19 +1,32 @@
+import os
 import json
+import time
+from collections import OrderedDict
+from itertools import groupby, islice
 import sqlalchemy
 from sqlalchemy import (
     Column,
     Integer,
     String,
     Text,
+    Float,
+    Index,
     select,
     update,
+    delete,
+    insert,
+    literal_column,
+    bindparam,
+    event,
 )
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import (
     DeclarativeBase,
     Session,
 )
 
-from typing import Sequence
+from typing import Sequence, Iterable, Iterator, Any, Generic, TypeVar, overload
 
 engine = None
 
@@ -35,14 +48,84 @@ class Paper(ModelBase):
     paper_citation = Column(Text) # JSON
     paper_year = Column(Text) # JSON
 
-Cite = tuple[str, str, int, str]
+class Citation(ModelBase):
+    """
+    normalized paper_citation, one row per cite of a paper
+    """
+    __tablename__ = "citation"
+    source_id = Column(Integer, primary_key=True) # citing paper
+    ordinal = Column(Integer, primary_key=True) # index in paper_citation
+    label = Column(Text)
+    raw = Column(Text) # bibitem text
+    target_id = Column(Integer) # cited paper, NULL if unresolved
+    title = Column(Text)
+    match_score = Column(Float) # title similarity of the resolved target
+    match_method = Column(Text) # how the target was matched, NULL if found at extraction
+    __table_args__ = (
+        Index('ix_citation_target_id', 'target_id'),
+    )
+
+PAPER_COLUMNS = ('paper_id', 'paper_title', 'website_url', 'author_list', 'paper_citation', 'paper_year')
+
+try:
+    import orjson # faster, optional
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+T = TypeVar('T')
+
+class LazyJSON(Generic[T]):
+    """
+    PaperData field holding the raw JSON `[ok, value]` until first access
+    the decoded field is `(True, value)`; `ok` is asserted if `check`
+    """
+    def __init__(self, check: bool = True) -> None:
+        self.check = check
+    
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.name = name
+        self.raw_slot = f"_raw_{name}"
+        self.value_slot = f"_{name}"
+    
+    @overload
+    def __get__(self, obj: None, objtype: type|None = None) -> 'LazyJSON[T]': ...
+    @overload
+    def __get__(self, obj: object, objtype: type|None = None) -> T: ...
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        raw = getattr(obj, self.raw_slot)
+        if raw is not None:
+            parsed = json_loads(raw)
+            if self.check:
+                assert parsed[0], f"invalid {self.name} of paper {obj.paper_id}"
+            setattr(obj, self.value_slot, (True, parsed[1]))
+            setattr(obj, self.raw_slot, None) # drop the raw text once decoded
+        return getattr(obj, self.value_slot)
+    
+    def __set__(self, obj, value: T) -> None:
+        setattr(obj, self.value_slot, value)
+        setattr(obj, self.raw_slot, None)
+    
+    def set_raw(self, obj, raw: str|bytes|None) -> None:
+        setattr(obj, self.value_slot, None)
+        setattr(obj, self.raw_slot, raw)
+
+Cite = list[Any] # [label, bibitem, target paper id or -1, title], decoded from JSON and updated when resolved
 class PaperData:
+    __slots__ = (
+        'paper_id', 'paper_title', 'website_url',
+        '_author_list', '_raw_author_list',
+        '_paper_citation', '_raw_paper_citation',
+        '_paper_year', '_raw_paper_year',
+    )
     paper_id: int
     paper_title: str
     website_url: str
-    author_list: tuple[bool, list[str]]
-    paper_citation: tuple[bool, list[Cite]]
-    paper_year: tuple[bool, str]
+    author_list = LazyJSON[tuple[bool, list[str]]]()
+    paper_citation = LazyJSON[tuple[bool, list[Cite]]](check=False)
+    paper_year = LazyJSON[tuple[bool, str]]()
 
     def __init__(
             self,
@@ -64,30 +147,22 @@ class PaperData:
         return f"PaperData({self.paper_title!r}, {self.website_url!r}, {self.author_list!r}, {self.paper_citation!r}, {self.paper_year!r}, {self.paper_id!r})"
     
     @staticmethod
-    def from_Paper(paper: Paper) -> 'PaperData':
-        paper_title = str(paper.paper_title)
-        website_url = str(paper.website_url)
-        
-        author_list_obj = json.loads(str(paper.author_list))
-        assert author_list_obj[0]
-        author_list = author_list_obj[1]
-        
-        paper_citation_obj = json.loads(str(paper.paper_citation))
-        # assert paper_citation_obj[0]
-        paper_citation = paper_citation_obj[1]
-        
-        paper_year_obj = json.loads(str(paper.paper_year))
-        assert paper_year_obj[0]
-        paper_year = paper_year_obj[1]
-        
-        return PaperData(
-            paper_title,
-            website_url,
-            (True, author_list),
-            (True, paper_citation),
-            (True, paper_year),
-            paper.paper_id
-        )
+    def from_Paper(paper: Paper, columns: Sequence[str] = None) -> 'PaperData':
+        """
+        JSON fields are kept raw and decoded on first access
+        @param paper: a Paper, or a row carrying the selected `columns` as attributes
+        @param columns: columns to convert, the others are left None; all if None
+        """
+        columns = PAPER_COLUMNS if columns is None else columns
+        res = PaperData.__new__(PaperData)
+        res.paper_id = paper.paper_id # type: ignore
+        res.paper_title = str(paper.paper_title) if 'paper_title' in columns else None # type: ignore
+        res.website_url = str(paper.website_url) if 'website_url' in columns else None # type: ignore
+        for name in ('author_list', 'paper_citation', 'paper_year'):
+            raw = getattr(paper, name) if name in columns else None
+            field: LazyJSON = vars(PaperData)[name]
+            field.set_raw(res, None if raw is None else str(raw))
+        return res
     def to_Paper(self) -> Paper:
         author_list_obj = json.dumps(self.author_list)
         paper_citation_obj = json.dumps(self.paper_citation)
@@ -101,9 +176,48 @@ class PaperData:
             paper_id=self.paper_id,
         )
 
-def init_engine(db_path: str):
-    global engine
-    engine = sqlalchemy.create_engine(db_path)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL', # readers do not block the writer and vice versa
+    'synchronous': 'NORMAL', # safe with WAL, fsync only at checkpoints
+    'cache_size': -64 * 1024, # KiB, 64MiB page cache per connection
+    'mmap_size': 1 << 30, # map up to 1GiB of the file
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30_000, # ms, wait for the lock instead of failing
+}
+
+def set_sqlite_pragmas(dbapi_conn, pragmas: dict = SQLITE_PRAGMAS) -> None:
+    cursor = dbapi_conn.cursor()
+    for key, value in pragmas.items():
+        cursor.execute(f"PRAGMA {key} = {value}")
+    cursor.close()
+
+def init_engine(db_path: str, tuned: bool = False, pool_size: int = 8):
+    """
+    @param tuned: for SQLite, switch to WAL and apply SQLITE_PRAGMAS on every connection,
+        keep a pool of `pool_size` connections
+    forked children always drop the connections inherited from the parent
+        WAL is persistent, the database file stays in WAL mode afterwards
+    """
+    global engine, validity_indexed
+    if tuned and db_path.startswith('sqlite') and db_path != 'sqlite://' and ':memory:' not in db_path:
+        engine = sqlalchemy.create_engine(
+            db_path,
+            pool_size=pool_size,
+            max_overflow=pool_size,
+            connect_args={'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000, 'check_same_thread': False},
+        )
+        event.listen(engine, 'connect', lambda dbapi_conn, _: set_sqlite_pragmas(dbapi_conn))
+    else:
+        engine = sqlalchemy.create_engine(db_path)
+    validity_indexed = None
+
+def dispose_engine_in_child() -> None:
+    # a forked worker must open its own connections
+    if engine is not None:
+        engine.dispose(close=False)
+
+if hasattr(os, 'register_at_fork'): # not on Windows, where workers are spawned
+    os.register_at_fork(after_in_child=dispose_engine_in_child)
 
 def select_paper_by_id(paper_id: int) -> Paper|None:
     stmt = select(Paper).where(Paper.paper_id == paper_id)
@@ -111,33 +225,295 @@ def select_paper_by_id(paper_id: int) -> Paper|None:
         res = session.scalar(stmt)
         return res
 
-paper_data_cache: dict[int, PaperData] = {}
+class PaperDataCache:
+    """
+    LRU cache of PaperData by paper_id
+    """
+    def __init__(self, maxsize: int = 65536) -> None:
+        self.maxsize = maxsize
+        self.data: OrderedDict[int, PaperData] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __contains__(self, paper_id: int) -> bool:
+        return paper_id in self.data
+    
+    def __len__(self) -> int:
+        return len(self.data)
+    
+    def get(self, paper_id: int) -> PaperData|None:
+        paper_data = self.data.get(paper_id)
+        if paper_data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.data.move_to_end(paper_id)
+        return paper_data
+    
+    def put(self, paper_id: int, paper_data: PaperData) -> None:
+        self.data[paper_id] = paper_data
+        self.data.move_to_end(paper_id)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+    
+    def clear(self) -> None:
+        self.data.clear()
+        self.hits = self.misses = 0
+    
+    def stats(self) -> dict[str, int|float]:
+        total = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.,
+        }
+
+paper_data_cache = PaperDataCache()
 def paper_data_by_id(paper_id: int) -> PaperData:
-    global paper_data_cache
-    if paper_id in paper_data_cache:
-        return paper_data_cache[paper_id]
+    if (paper_data := paper_data_cache.get(paper_id)) is not None:
+        return paper_data
     paper = select_paper_by_id(paper_id)
     assert paper
     paper_data = PaperData.from_Paper(paper)
-    paper_data_cache[paper_id] = paper_data
+    paper_data_cache.put(paper_id, paper_data)
     return paper_data
 
+def prefetch(paper_ids: Iterable[int], chunk_size: int = 500) -> int:
+    """
+    load the papers missing in paper_data_cache with one query per chunk
+    only the last `maxsize` papers stay if more are requested
+    @return number of papers loaded
+    """
+    missing = list(dict.fromkeys(i for i in paper_ids if i not in paper_data_cache))
+    loaded = 0
+    with Session(engine) as session:
+        for i in range(0, len(missing), chunk_size):
+            stmt = select(Paper).where(Paper.paper_id.in_(missing[i: i + chunk_size]))
+            for paper in session.scalars(stmt):
+                paper_data_cache.put(int(paper.paper_id), PaperData.from_Paper(paper)) # type: ignore
+                loaded += 1
+    return loaded
+
 def select_paper_all() -> Sequence[Paper]:
     stmt = select(Paper)
     with Session(engine) as session:
         res = session.execute(stmt)
         return res.scalars().all()
 
+# a paper is valid when its citations were extracted: paper_citation = [true, [...]]
+VALID_CITATION_SQL = "substr(paper_citation, 1, 5) = '[true'"
+validity_indexed: bool|None = None # None: not checked yet
+
+def ensure_validity_index() -> bool:
+    """
+    migration, see add_validity_index.py: add the virtual generated column
+    paper_data.citation_valid and index it
+    it follows paper_citation automatically, so it never needs a backfill
+    @return False if the database cannot be altered (e.g. read-only)
+    """
+    global validity_indexed
+    try:
+        with engine.begin() as conn: # type: ignore
+            cols = [row[1] for row in conn.exec_driver_sql("PRAGMA table_xinfo(paper_data)")]
+            if 'citation_valid' not in cols:
+                conn.exec_driver_sql(
+                    f"ALTER TABLE paper_data ADD COLUMN citation_valid INTEGER GENERATED ALWAYS AS ({VALID_CITATION_SQL}) VIRTUAL"
+                )
+            conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_paper_data_citation_valid ON paper_data (citation_valid)")
+        validity_indexed = True
+    except OperationalError:
+        validity_indexed = None # check the schema again on the next query
+        return False
+    return True
+
+def has_validity_column() -> bool:
+    """
+    whether ensure_validity_index was run on the database, never alters it
+    """
+    global validity_indexed
+    if validity_indexed is None:
+        with engine.connect() as conn: # type: ignore
+            cols = [row[1] for row in conn.exec_driver_sql("PRAGMA table_xinfo(paper_data)")]
+        validity_indexed = 'citation_valid' in cols
+    return validity_indexed
+
+def valid_paper_clause():
+    """
+    SQL filter selecting valid papers, by the indexed column if the database has it
+    """
+    if has_validity_column():
+        return literal_column("citation_valid") == 1
+    return literal_column(VALID_CITATION_SQL)
+
+def iter_paper(columns: Sequence[str] = None, batch_size: int = 1000, where: Sequence = ()) -> Iterator:
+    """
+    stream rows of paper_data in batches instead of loading the whole table
+    @param columns: columns to select, paper_id is always included; all if None
+    @param where: extra filter clauses
+    """
+    columns = PAPER_COLUMNS if columns is None else columns
+    names = ['paper_id'] + [c for c in columns if c != 'paper_id']
+    stmt = select(*(getattr(Paper, c) for c in names)).where(*where).execution_options(yield_per=batch_size)
+    with Session(engine) as session:
+        yield from session.execute(stmt)
+
+def iter_paper_data(columns: Sequence[str] = None, batch_size: int = 1000, where: Sequence = ()) -> Iterator[PaperData]:
+    """
+    lazily build PaperData from streamed rows, unselected fields are None
+    """
+    columns = PAPER_COLUMNS if columns is None else columns
+    for row in iter_paper(columns, batch_size, where):
+        yield PaperData.from_Paper(row, columns)
+
+def iter_valid_paper(columns: Sequence[str] = None, batch_size: int = 1000) -> Iterator:
+    return iter_paper(columns, batch_size, where=[valid_paper_clause()])
+
+def iter_valid_paper_data(columns: Sequence[str] = None, batch_size: int = 1000) -> Iterator[PaperData]:
+    return iter_paper_data(columns, batch_size, where=[valid_paper_clause()])
+
+def count_valid_papers() -> int:
+    stmt = select(sqlalchemy.func.count()).select_from(Paper).where(valid_paper_clause())
+    with Session(engine) as session:
+        return session.scalar(stmt) or 0
+
+def ensure_citation_table() -> None:
+    ModelBase.metadata.create_all(engine, tables=[Citation.__table__]) # type: ignore
+    with engine.begin() as conn: # type: ignore
+        # tables created before the match columns existed
+        cols = [row[1] for row in conn.exec_driver_sql("PRAGMA table_info(citation)")]
+        for name, sql_type in (('match_score', 'REAL'), ('match_method', 'TEXT')):
+            if name not in cols:
+                conn.exec_driver_sql(f"ALTER TABLE citation ADD COLUMN {name} {sql_type}")
+
+def citation_rows(paper_id: int, cites: list[Cite]) -> list[dict]:
+    return [{
+        'source_id': paper_id,
+        'ordinal': i,
+        'label': cite[0],
+        'raw': cite[1],
+        'target_id': cite[2] if cite[2] != -1 else None,
+        'title': cite[3] if len(cite) > 3 and cite[3] != '' else None,
+        'match_score': None,
+        'match_method': None,
+    } for i, cite in enumerate(cites)]
+
+def backfill_citations(batch_size: int = 1000) -> int:
+    """
+    (re)build the citation table from paper_citation of valid papers
+    rows are written by executemany, one transaction per batch of papers
+    @return number of citation rows written
+    """
+    ensure_citation_table()
+    total = 0
+    last_id = -1
+    while True:
+        # keyset pagination, no read cursor stays open while writing
+        stmt = (
+            select(Paper.paper_id, Paper.paper_citation)
+            .where(valid_paper_clause(), Paper.paper_id > last_id)
+            .order_by(Paper.paper_id)
+            .limit(batch_size)
+        )
+        with Session(engine) as session:
+            batch = session.execute(stmt).all()
+            if not batch:
+                break
+            last_id = batch[-1].paper_id
+            rows = [row for paper_id, raw in batch for row in citation_rows(paper_id, json.loads(raw)[1])]
+            source_ids = [paper_id for paper_id, _ in batch]
+            # keep how still valid targets were matched
+            matched = select(Citation.source_id, Citation.ordinal, Citation.target_id, Citation.match_score, Citation.match_method).where(
+                Citation.source_id.in_(source_ids), Citation.match_method.is_not(None),
+            )
+            matches = {(s, o): (t, score, method) for s, o, t, score, method in session.execute(matched)}
+            for row in rows:
+                target_id, score, method = matches.get((row['source_id'], row['ordinal']), (None, None, None))
+                if target_id is not None and target_id == row['target_id']:
+                    row['match_score'], row['match_method'] = score, method
+            session.execute(delete(Citation).where(Citation.source_id.in_(source_ids)))
+            if rows:
+                session.execute(insert(Citation), rows)
+            session.commit()
+        total += len(rows)
+    return total
+
+def save_citation_matches(rows: Iterable[dict], chunk_size: int = 5000) -> int:
+    """
+    upsert citation rows of resolved citations, keeping target_id, match_score and match_method
+    @param rows: rows of citation_rows with target_id and the match columns filled
+    @return number of rows written
+    """
+    ensure_citation_table()
+    stmt = sqlite_insert(Citation)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Citation.source_id, Citation.ordinal],
+        set_={name: stmt.excluded[name] for name in ('target_id', 'match_score', 'match_method')},
+    )
+    total = 0
+    it = iter(rows)
+    while chunk := list(islice(it, chunk_size)):
+        with engine.begin() as conn: # type: ignore
+            conn.execute(stmt, chunk)
+        total += len(chunk)
+    return total
+
+def citing_papers(target_id: int) -> list[int]:
+    stmt = select(Citation.source_id).where(Citation.target_id == target_id).distinct()
+    with Session(engine) as session:
+        return list(session.scalars(stmt))
+
+def iter_unresolved_citations(batch_size: int = 1000) -> Iterator:
+    stmt = select(Citation).where(Citation.target_id.is_(None)).execution_options(yield_per=batch_size)
+    with Session(engine) as session:
+        yield from session.scalars(stmt)
+
+def select_citation_edges() -> list[tuple[int, int]]:
+    """
+    distinct (source_id, target_id) of resolved citations
+    """
+    stmt = select(Citation.source_id, Citation.target_id).where(Citation.target_id.is_not(None)).distinct()
+    with Session(engine) as session:
+        return [(s, t) for s, t in session.execute(stmt)]
+
 def update_paper(paper: Paper, column: str):
     stmt = update(Paper).where(Paper.paper_id == paper.paper_id).values({column: paper.__getattribute__(column)})
     with Session(engine) as session:
         session.execute(stmt)
         session.commit()
 
+def update_papers(updates: Iterable[tuple[int, str, Any]], chunk_size: int = 5000) -> dict[str, float]:
+    """
+    bulk version of update_paper
+    @param updates: (paper_id, column, value), non-str values are stored as JSON
+    every chunk is written in one transaction, by one executemany per column
+    @return rows written, seconds and rows per second
+    """
+    start = time.perf_counter()
+    rows = 0
+    it = iter(updates)
+    while chunk := list(islice(it, chunk_size)):
+        chunk.sort(key=lambda u: u[1])
+        with engine.begin() as conn: # type: ignore
+            for column, group in groupby(chunk, key=lambda u: u[1]):
+                stmt = (
+                    update(Paper)
+                    .where(Paper.paper_id == bindparam('b_paper_id'))
+                    .values({column: bindparam('b_value')})
+                    .execution_options(synchronize_session=False)
+                )
+                params = [{
+                    'b_paper_id': paper_id,
+                    'b_value': value if isinstance(value, str) else json.dumps(value),
+                } for paper_id, _, value in group]
+                conn.execute(stmt, params)
+                rows += len(params)
+    elapsed = time.perf_counter() - start
+    return {'rows': rows, 'seconds': elapsed, 'rows_per_s': rows / elapsed if elapsed else 0.}
+
 if __name__ == '__main__':
     init_engine("sqlite:///database.db")
-    papers = select_paper_all()
-    for paper in papers:
+    for paper in iter_paper_data():
         print(paper)
-        print(PaperData.from_Paper(paper))
-        print()
\ No newline at end of file
+        print()
@@ -1,5 +1,8 @@
 import sys
-from dataclasses import dataclass
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from itertools import groupby, chain, islice
 import re
 import copy
@@ -44,6 +47,11 @@ from loguru import logger
 
 from typing import cast, Iterator, Optional, Iterable, Sequence
 
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
 # (cid:xxx)
 cid_pattern = re.compile(r"\(cid:\d+\)")
 class Bibitem:
@@ -138,12 +146,53 @@ class UnnumberedIntegrity(ResultIntegrity):
     ok_labels: list[str] # labels which exist and are matched to bibitems
     pass # TODO
 
+@dataclass
+class StageStat:
+    name: str
+    wall: float # seconds
+    cpu: float # seconds, process time
+    mem_peak: int = 0 # bytes, tracemalloc peak above the stage start, 0 if not tracing
+    rss_delta: int = 0 # bytes, growth of the process peak RSS during the stage
+
+def _peak_rss() -> int:
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KB on Linux
+
+@contextmanager
+def stage(name: str, stats: list[StageStat]):
+    """
+    record wall time, cpu time and memory usage of the enclosed block into `stats`
+    memory peak is only measured when tracemalloc is tracing
+    """
+    tracing = tracemalloc.is_tracing()
+    mem_start = 0
+    if tracing:
+        mem_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    rss_start = _peak_rss()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        stat = StageStat(
+            name,
+            time.perf_counter() - wall_start,
+            time.process_time() - cpu_start,
+            rss_delta=_peak_rss() - rss_start,
+        )
+        if tracing:
+            stat.mem_peak = tracemalloc.get_traced_memory()[1] - mem_start
+        stats.append(stat)
+        logger.debug(f"[Stage] {name}: {stat.wall:.3f}s wall, {stat.cpu:.3f}s cpu")
+
 @dataclass
 class PDFResult:
     cites: list[Citation]
     dests: list[Destination]
     bibs: list[Bibitem]
     _valids: Optional[list[Citation]] = None
+    stages: list[StageStat] = field(default_factory=list) # per-stage timing of `deal`
     def summary(self, need_sort: bool = True) -> list[str]:
         valids = self.valids
         res = []
@@ -274,12 +323,18 @@ def collect_cites(reader: PdfReader) -> list[Citation]:
                 elif isinstance(dest_obj, ArrayObject): # Explicit Destination
                     target_page, fit, *args = dest_obj
                     dest_obj = PDFDestination('', target_page, Fit(fit, tuple(args)))
+                    pos: float|Point|None = None
+                    if fit == '/XYZ' and dest_obj.left is not None and dest_obj.top is not None:
+                        pos = (dest_obj.left.as_numeric(), dest_obj.top.as_numeric())
+                    elif fit == '/FitH' and dest_obj.top is not None:
+                        pos = dest_obj.top.as_numeric()
                     res.append(Citation(
                         page_idx,
                         rect,
                         destination=Destination(
                             dest_obj,
                             reader.get_destination_page_number(dest_obj),
+                            pos=pos,
                         ),
                     ))
                     # page, 
@@ -672,18 +727,36 @@ def collect_bibs(pages: list[LTPage], split_LR: bool = False) -> list[list[Bibit
     return all_bibs
 
 @logger.catch(reraise=True)
-def deal(fname: str, parscit: bool = True, detail: dict = None) -> PDFResult:
+def deal(fname: str, parscit: bool = True, detail: dict = None, trace_memory: bool = False, stats: list[StageStat] = None) -> PDFResult:
+    """
+    @param trace_memory: measure the memory peak of each stage by tracemalloc (slower)
+    @param stats: list receiving the stage stats, it keeps the finished stages and the failing one if deal raises
+    """
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        return _deal(fname, parscit, detail, [] if stats is None else stats)
+    finally:
+        if started:
+            tracemalloc.stop()
+
+def _deal(fname: str, parscit: bool, detail: dict|None, stats: list[StageStat]) -> PDFResult:
     reader = PyPDF2.PdfReader(fname)
     if len(reader.pages) > 100:
         logger.warning(f"Too many pages: {reader.numPages}, maybe not a paper")
         raise RuntimeError("Too many pages")
-    dests = collect_dests(reader)
+    with stage('collect_dests', stats):
+        dests = collect_dests(reader)
     if detail: detail['dests'] = copy.deepcopy(dests) # for debug
-    cites = collect_cites(reader)
+    with stage('collect_cites', stats):
+        cites = collect_cites(reader)
     if detail: detail['links'] = copy.deepcopy(cites)
     
-    pages = list(extract_pages(fname)) # use pdfminer for layout analysis
-    extract_text_in_figures(pages)
+    with stage('extract_pages', stats):
+        pages = list(extract_pages(fname)) # use pdfminer for layout analysis
+    with stage('extract_text_in_figures', stats):
+        extract_text_in_figures(pages)
     # logger.debug(extract_text(fname))
     
     # page_imgs = get_images(fname)
@@ -709,28 +782,34 @@ def deal(fname: str, parscit: bool = True, detail: dict = None) -> PDFResult:
     #         save_img(f"cite_img/{img_cnt}", textbox_img, textbox.bbox, targets, 'LabelMe')
     #         img_cnt += 1
     
-    splited_layout = judge_split_LR(pages) # is the document splited into left and right parts?
-    bibs = collect_bibs(pages, splited_layout)
+    with stage('judge_split_LR', stats):
+        splited_layout = judge_split_LR(pages) # is the document splited into left and right parts?
+    with stage('collect_bibs', stats):
+        bibs = collect_bibs(pages, splited_layout)
     if detail: detail['bibs'] = copy.deepcopy(bibs)
     if parscit:
-        detect_title(bibs)
+        with stage('detect_title', stats):
+            detect_title(bibs)
         bibs = [[bib for bib in page if bib.title] for page in bibs]
     # splited_layout = False
     logger.success(f"Detected split_LR: {splited_layout}")
     
-    flat_pages_: list[list[tuple[str, ImuLayoutPath]]] = [[] for _ in pages]
-    [flatten_page(page, [page], flat_page) for page, flat_page in zip(pages, flat_pages_)]
-    flat_pages: list[tuple[str, list[ImuLayoutPath]]] = []
-    for page in flat_pages_:
-        text = ''.join(text for text, _ in page)
-        assert len(text) == len(page)
-        flat_pages.append((text, [path for _, path in page]))
+    with stage('flatten_page', stats):
+        flat_pages_: list[list[tuple[str, ImuLayoutPath]]] = [[] for _ in pages]
+        [flatten_page(page, [page], flat_page) for page, flat_page in zip(pages, flat_pages_)]
+        flat_pages: list[tuple[str, list[ImuLayoutPath]]] = []
+        for page in flat_pages_:
+            text = ''.join(text for text, _ in page)
+            assert len(text) == len(page)
+            flat_pages.append((text, [path for _, path in page]))
     # doc_text = ''.join(text for text, _ in flat_pages)
     # logger.debug(f"Document text: {doc_text}")
     if len(cites) < 5: # maybe no link
-        cites.extend(detect_citation(flat_pages))
+        with stage('detect_citation', stats):
+            cites.extend(detect_citation(flat_pages))
     
-    match_context(pages, cites)
+    with stage('match_context', stats):
+        match_context(pages, cites)
     cites = [cite for cite in cites if cite.text and cite.context]
     if detail: detail['contexted_cites'] = copy.deepcopy(cites)
     
@@ -749,11 +828,12 @@ def deal(fname: str, parscit: bool = True, detail: dict = None) -> PDFResult:
     cites = [cite for cite in cites if cite.destination or cite.linkname is None]
     if detail: detail['cites'] = copy.deepcopy(cites)
     
-    match_bibitem(bibs, cites)
+    with stage('match_bibitem', stats):
+        match_bibitem(bibs, cites)
     if detail: detail['cite_cands'] = copy.deepcopy(cites)
     
     bibs = list(chain.from_iterable(bibs))
-    return PDFResult(cites, dests, bibs)
+    return PDFResult(cites, dests, bibs, stages=stats)
 
 if __name__ == '__main__':
     fname = "pdf/2201.02915.pdf"
@@ -761,6 +841,8 @@ if __name__ == '__main__':
         fname = sys.argv[1]
     result = deal(fname)
     result.summary()
+    for stat in result.stages:
+        logger.info(f"{stat.name}: {stat.wall:.3f}s wall, {stat.cpu:.3f}s cpu")
     
     integrity = result.integrity()
     if isinstance(integrity, NumberedIntegrity):
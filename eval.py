@@ -1,4 +1,12 @@
-from deal_pdf import deal, NumberedIntegrity, UnnumberedIntegrity
+import os
+import sys
+import json
+import time
+import argparse
+from dataclasses import dataclass, asdict
+from multiprocessing import Pool
+
+from deal_pdf import deal, NumberedIntegrity, UnnumberedIntegrity, _peak_rss
 
 from loguru import logger
 logger.disable("deal_pdf")
@@ -23,27 +31,124 @@ testset2 = {
     "Alargeannotatedcorpusforlearningnaturallanguageinference.pdf": 35,
 }
 
-if __name__ == '__main__':
-    accs1 = []
-    logger.info("Testing numbered papers")
-    for fname, ans in testset1.items():
-        logger.info(f"Testing {fname}")
-        result = deal(f"pdf/{fname}")
-        integrity = result.integrity()
-        assert isinstance(integrity, NumberedIntegrity)
-        logger.success(f"Result {len(integrity.ok_labels)} / {ans}")
-        accs1.append(len(integrity.ok_labels) / ans)
-    logger.success(f"Numbered Average accuracy: {sum(accs1) / len(accs1):.3f}")
-    
-    accs2 = []
-    logger.info("Testing unnumbered papers")
-    for fname, ans in testset2.items():
-        logger.info(f"Testing {fname}")
-        result = deal(f"pdf/{fname}")
+@dataclass
+class CaseResult:
+    fname: str
+    numbered: bool
+    found: int
+    expected: int
+    acc: float
+    runtime: float # seconds
+    peak_rss: int # bytes, peak RSS of the worker process
+    error: str = ''
+
+def run_case(fname: str, ans: int, numbered: bool, pdf_dir: str = 'pdf') -> CaseResult:
+    """
+    run `deal` on one test case, the worker process is not reused
+    so that its peak RSS belongs to this case only
+    """
+    start = time.perf_counter()
+    error = ''
+    found = 0
+    try:
+        result = deal(os.path.join(pdf_dir, fname))
         integrity = result.integrity()
-        assert isinstance(integrity, UnnumberedIntegrity)
-        ok_bibs = [cite.target for cite in result.valids if cite.target]
-        ok_bibs = set(ok_bibs)
-        logger.success(f"Result {len(ok_bibs)} / {ans}")
-        accs2.append(len(ok_bibs) / ans)
-    logger.success(f"Unnumbered Average accuracy: {sum(accs2) / len(accs2):.3f}")
\ No newline at end of file
+        if numbered:
+            assert isinstance(integrity, NumberedIntegrity)
+            found = len(integrity.ok_labels)
+        else:
+            assert isinstance(integrity, UnnumberedIntegrity)
+            ok_bibs = set(cite.target for cite in result.valids if cite.target)
+            found = len(ok_bibs)
+    except Exception as e:
+        error = repr(e)
+    runtime = time.perf_counter() - start
+    peak_rss = _peak_rss()
+    return CaseResult(fname, numbered, found, ans, found / ans, runtime, peak_rss, error)
+
+def run_all(workers: int, pdf_dir: str = 'pdf') -> list[CaseResult]:
+    cases = [(fname, ans, True, pdf_dir) for fname, ans in testset1.items()]
+    cases += [(fname, ans, False, pdf_dir) for fname, ans in testset2.items()]
+    with Pool(workers, maxtasksperchild=1) as pool:
+        return pool.starmap(run_case, cases, chunksize=1)
+
+def compare(
+        results: list[CaseResult],
+        baseline: dict[str, dict],
+        time_threshold: float,
+        time_slack: float,
+        mem_threshold: float = 1.2,
+        mem_slack: float = 64 * 2**20,
+        check_time: bool = True,
+) -> list[str]:
+    """
+    compare results with the baseline: accuracy, runtime and peak RSS of every file,
+    and files of the baseline missing from the results
+    @param mem_slack: allowed absolute peak RSS increase per file, bytes
+    @param check_time: compare runtimes, which are only comparable with the same number of workers
+    @return regressions found, empty if none
+    """
+    problems: list[str] = []
+    for fname in sorted(baseline.keys() - {res.fname for res in results}):
+        problems.append(f"{fname}: in baseline but not run")
+    total_time = total_base_time = 0.
+    for res in results:
+        base = baseline.get(res.fname)
+        if res.error:
+            problems.append(f"{res.fname}: failed with {res.error}")
+        if base is None:
+            logger.warning(f"{res.fname}: not in baseline")
+            continue
+        if res.acc < base['acc']:
+            problems.append(f"{res.fname}: accuracy {res.acc:.3f} < baseline {base['acc']:.3f}")
+        if check_time and res.runtime > base['runtime'] * time_threshold + time_slack:
+            problems.append(f"{res.fname}: runtime {res.runtime:.2f}s > baseline {base['runtime']:.2f}s")
+        if base.get('peak_rss') and res.peak_rss > base['peak_rss'] * mem_threshold + mem_slack:
+            problems.append(f"{res.fname}: peak RSS {res.peak_rss / 2**20:.0f}MB > baseline {base['peak_rss'] / 2**20:.0f}MB")
+        total_time += res.runtime
+        total_base_time += base['runtime']
+    if check_time and total_base_time and total_time > total_base_time * time_threshold:
+        problems.append(f"total runtime {total_time:.2f}s > baseline {total_base_time:.2f}s")
+    return problems
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="accuracy and performance regression benchmark")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--pdf-dir', default='pdf')
+    parser.add_argument('--baseline', default='eval_baseline.json')
+    parser.add_argument('--update-baseline', action='store_true', help="store this run as the new baseline")
+    parser.add_argument('--time-threshold', type=float, default=1.2, help="allowed runtime ratio against the baseline")
+    parser.add_argument('--time-slack', type=float, default=0.5, help="allowed absolute runtime increase per file, seconds")
+    parser.add_argument('--mem-threshold', type=float, default=1.2, help="allowed peak RSS ratio against the baseline")
+    parser.add_argument('--mem-slack', type=float, default=64, help="allowed absolute peak RSS increase per file, MB")
+    args = parser.parse_args()
+
+    results = run_all(args.workers, args.pdf_dir)
+    for res in results:
+        logger.info(f"{res.fname}: {res.found} / {res.expected} in {res.runtime:.2f}s, peak RSS {res.peak_rss / 2**20:.0f}MB")
+    for numbered, name in ((True, 'Numbered'), (False, 'Unnumbered')):
+        accs = [res.acc for res in results if res.numbered == numbered]
+        logger.success(f"{name} Average accuracy: {sum(accs) / len(accs):.3f}")
+    logger.success(f"Total runtime: {sum(res.runtime for res in results):.2f}s")
+
+    if args.update_baseline:
+        baseline = {'workers': args.workers, 'results': {res.fname: asdict(res) for res in results}}
+        json.dump(baseline, open(args.baseline, 'w'), indent=4)
+        logger.success(f"Baseline saved to {args.baseline}")
+        sys.exit(0)
+    if not os.path.exists(args.baseline):
+        logger.warning(f"No baseline at {args.baseline}, run with --update-baseline first")
+        sys.exit(0)
+    baseline = json.load(open(args.baseline, 'r'))
+    if 'results' not in baseline: # older baselines hold the results only
+        baseline = {'workers': None, 'results': baseline}
+    check_time = baseline['workers'] == args.workers
+    if not check_time:
+        logger.warning(f"Baseline ran with {baseline['workers'] or 'an unknown number of'} workers, this run with {args.workers}: "
+                       f"runtimes are not compared, rerun with the workers of the baseline or --update-baseline")
+    problems = compare(results, baseline['results'], args.time_threshold, args.time_slack, args.mem_threshold, args.mem_slack * 2**20, check_time)
+    for problem in problems:
+        logger.error(problem)
+    if problems:
+        sys.exit(1)
+    logger.success("No regression against the baseline")
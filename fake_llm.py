@@ -0,0 +1,126 @@
+"""
+local fake of the OpenAI completion APIs for offline benchmarks
+every request is answered after a fixed latency, optionally failing with 429
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+batch_item_pattern = re.compile(r"^\[(\d+)\] context:", re.M)
+def fake_answer(prompt: str, answer: str = "Neutral", garble_rate: float = 0.) -> str:
+    """
+    answer single prompts with `answer`, and batched prompts of stance.py with one line per item
+    """
+    items = batch_item_pattern.findall(prompt)
+    if not items:
+        return answer
+    if random.random() < garble_rate:
+        return f"I think most of them are {answer}."
+    return "\n".join(f"{idx}: {answer}" for idx in items)
+
+class StubAgent:
+    """
+    in-process stand-in of GPTAgent counting calls and tokens
+    """
+    def __init__(self, answer: str = "Neutral", garble_rate: float = 0.) -> None:
+        self.answer = answer
+        self.garble_rate = garble_rate
+        self.stats = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        self.lock = threading.Lock()
+    def predict(self, text: str) -> str:
+        res = fake_answer(text, self.answer, self.garble_rate)
+        with self.lock:
+            self.stats['calls'] += 1
+            self.stats['prompt_tokens'] += len(text) // 4 + 1
+            self.stats['completion_tokens'] += len(res) // 4 + 1
+        return res
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.5 # seconds
+    fail_rate = 0.
+    answer = "Neutral"
+    stats = {'requests': 0, 'prompt_tokens': 0, 'failed': 0}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args) -> None:
+        pass # keep benchmarks quiet
+
+    def send_json(self, code: int, obj: dict) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.stats_lock:
+                self.send_json(200, dict(self.stats))
+        else:
+            self.send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self) -> None:
+        req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if 'messages' in req:
+            prompt = ''.join(str(m.get('content', '')) for m in req['messages'])
+        else:
+            prompt = req.get('prompt', '')
+            prompt = ''.join(prompt) if isinstance(prompt, list) else str(prompt)
+        prompt_tokens = len(prompt) // 4 + 1
+        time.sleep(self.latency)
+        failed = random.random() < self.fail_rate
+        with self.stats_lock:
+            self.stats['requests'] += 1
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['failed'] += failed
+        if failed:
+            self.send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}})
+            return
+        content = fake_answer(prompt, self.answer)
+        completion_tokens = len(content) // 4 + 1
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+        model = req.get('model', 'fake')
+        if self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(200, {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+        elif self.path.rstrip('/').endswith('/completions'):
+            self.send_json(200, {
+                'id': 'cmpl-fake', 'object': 'text_completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'text': content, 'logprobs': None, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+        else:
+            self.send_json(404, {'error': {'message': 'not found'}})
+
+def serve(port: int = 8000, latency: float = 0.5, fail_rate: float = 0., answer: str = "Neutral") -> ThreadingHTTPServer:
+    """
+    start the server in a daemon thread, the API base is http://127.0.0.1:<port>/v1
+    """
+    FakeLLMHandler.latency = latency
+    FakeLLMHandler.fail_rate = fail_rate
+    FakeLLMHandler.answer = answer
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="fake OpenAI-compatible endpoint")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5)
+    parser.add_argument('--fail-rate', type=float, default=0.)
+    parser.add_argument('--answer', default="Neutral")
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.fail_rate, args.answer)
+    print(f"Serving on http://127.0.0.1:{args.port}/v1")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
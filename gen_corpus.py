@@ -0,0 +1,305 @@
+"""
+synthetic PDF corpus for offline benchmarking of deal_pdf
+every generated `<name>.pdf` comes with `<name>.json` holding the ground truth
+
+PDFs are written by hand (Courier only, so geometry is trivial to compute),
+no extra dependency is needed
+"""
+import os
+import json
+import random
+import argparse
+from dataclasses import dataclass, asdict, field
+
+from typing import Literal
+
+PAGE_W, PAGE_H = 612, 792 # letter
+MARGIN = 54
+COL_GAP = 18
+FONT_SIZE = 9
+CHAR_W = FONT_SIZE * 0.6 # Courier is monospaced
+LINE_H = 11
+PARA_GAP = 14 # extra space between paragraphs, lets pdfminer split textboxes
+
+WORDS = (
+    "the of model data learning results method network we propose show that our approach "
+    "performance training task language neural representation based on using which this "
+    "improve evaluate across baseline experiments large scale robust efficient analysis "
+    "previous work problem setting structure features inference corpus benchmark accuracy"
+).split()
+SYLLABLES = "ka lo mi ne ru sa ti vo be da fe gi ho ju ly ma no pe ri su".split()
+VENUES = ["NeurIPS", "ICML", "ACL", "EMNLP", "CVPR", "ICLR", "AAAI", "TACL"]
+
+@dataclass
+class CorpusSpec:
+    pages: int = 8 # pages of body text, the references follow on new pages
+    columns: Literal[1, 2] = 2
+    refs: int = 40 # number of bibitems
+    cites_per_page: int = 12
+    links: Literal['named', 'explicit', 'none'] = 'named' # how citations link to bibitems
+    style: Literal['numbered', 'author_year'] = 'numbered'
+    seed: int = 0
+
+@dataclass
+class RefTruth:
+    key: str # cite.<key> is the named destination
+    label: str # "3" for numbered, "" for author-year
+    title: str
+    authors: list[str]
+    year: int
+    page: int = -1 # page index, start from 0
+
+@dataclass
+class CiteTruth:
+    page: int
+    rect: tuple[float, float, float, float]
+    text: str
+    key: str
+
+@dataclass
+class _Line:
+    text: str
+    cites: list[tuple[int, str, str]] = field(default_factory=list) # (column offset, text, key)
+
+def _escape(s: str) -> str:
+    return s.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+class PDFWriter:
+    """
+    minimal PDF writer: Courier text, link annotations and named destinations
+    """
+    def __init__(self) -> None:
+        self.objs: list[bytes] = []
+
+    def reserve(self) -> int:
+        self.objs.append(b'')
+        return len(self.objs)
+
+    def set(self, obj_id: int, body: str|bytes) -> None:
+        self.objs[obj_id - 1] = body.encode('latin-1') if isinstance(body, str) else body
+
+    def add(self, body: str|bytes) -> int:
+        obj_id = self.reserve()
+        self.set(obj_id, body)
+        return obj_id
+
+    def stream(self, data: str) -> int:
+        raw = data.encode('latin-1')
+        return self.add(b'<< /Length %d >>\nstream\n' % len(raw) + raw + b'\nendstream')
+
+    def write(self, path: str, root: int) -> None:
+        out = bytearray(b'%PDF-1.4\n')
+        offsets = []
+        for idx, body in enumerate(self.objs):
+            offsets.append(len(out))
+            out += b'%d 0 obj\n' % (idx + 1) + body + b'\nendobj\n'
+        xref = len(out)
+        out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(self.objs) + 1)
+        for off in offsets:
+            out += b'%010d 00000 n \n' % off
+        out += b'trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(self.objs) + 1, root, xref)
+        with open(path, 'wb') as f:
+            f.write(out)
+
+class Layout:
+    """
+    flow lines through columns and pages, top to bottom
+    """
+    def __init__(self, columns: int) -> None:
+        self.columns = columns
+        self.col_w = (PAGE_W - 2 * MARGIN - COL_GAP * (columns - 1)) / columns
+        self.chars = int(self.col_w // CHAR_W)
+        self.pages: list[list[tuple[float, float, _Line]]] = [] # (x, baseline y, line)
+        self.new_page()
+
+    def new_page(self) -> None:
+        self.pages.append([])
+        self.col = 0
+        self.y = PAGE_H - MARGIN - FONT_SIZE
+
+    def next_column(self) -> None:
+        self.col += 1
+        self.y = PAGE_H - MARGIN - FONT_SIZE
+        if self.col >= self.columns:
+            self.new_page()
+
+    @property
+    def x(self) -> float:
+        return MARGIN + self.col * (self.col_w + COL_GAP)
+
+    def fits(self, n_lines: int) -> bool:
+        return self.y - (n_lines - 1) * LINE_H >= MARGIN
+
+    def place(self, lines: list[_Line], keep_together: bool = False) -> tuple[int, float, float]:
+        """
+        @return (page, x, y) of the first line
+        """
+        if keep_together and not self.fits(len(lines)) and len(lines) * LINE_H < PAGE_H - 2 * MARGIN:
+            self.next_column()
+        first = None
+        for line in lines:
+            if not self.fits(1):
+                self.next_column()
+            self.pages[-1].append((self.x, self.y, line))
+            if first is None:
+                first = (len(self.pages) - 1, self.x, self.y)
+            self.y -= LINE_H
+        self.y -= PARA_GAP
+        assert first is not None
+        return first
+
+def wrap(tokens: list[tuple[str, str|None]], width: int) -> list[_Line]:
+    """
+    greedy wrapping, a citation token (text, key) is never broken
+    """
+    lines: list[_Line] = [_Line('')]
+    for text, key in tokens:
+        cur = lines[-1]
+        if cur.text and len(cur.text) + 1 + len(text) > width:
+            cur = _Line('')
+            lines.append(cur)
+        if cur.text:
+            cur.text += ' '
+        if key is not None:
+            cur.cites.append((len(cur.text), text, key))
+        cur.text += text
+    return lines
+
+def make_refs(spec: CorpusSpec, rng: random.Random) -> list[RefTruth]:
+    refs: list[RefTruth] = []
+    used: set[str] = set()
+    def surname() -> str:
+        while True:
+            name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+            if name not in used:
+                used.add(name)
+                return name
+    for i in range(spec.refs):
+        authors = [surname() for _ in range(rng.choice([1, 2, 3, 4]))]
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 10))).capitalize()
+        label = str(i + 1) if spec.style == 'numbered' else ''
+        refs.append(RefTruth(f"ref{i:05d}", label, title, authors, rng.randint(1990, 2023)))
+    return refs
+
+def cite_text(ref: RefTruth, style: str) -> str:
+    if style == 'numbered':
+        return f"[{ref.label}]"
+    if len(ref.authors) == 1:
+        return f"{ref.authors[0]}, {ref.year}"
+    if len(ref.authors) == 2:
+        return f"{ref.authors[0]} and {ref.authors[1]}, {ref.year}"
+    return f"{ref.authors[0]} et al., {ref.year}"
+
+def bib_text(ref: RefTruth, style: str, rng: random.Random) -> str:
+    authors = ', '.join(f"{chr(65 + rng.randint(0, 25))}. {a}" for a in ref.authors)
+    venue = rng.choice(VENUES)
+    if style == 'numbered':
+        return f"[{ref.label}] {authors}. {ref.title}. In {venue}, {ref.year}."
+    return f"{authors}. {ref.year}. {ref.title}. In {venue}."
+
+def generate(spec: CorpusSpec, path: str) -> dict:
+    """
+    write the PDF to `path` and its ground truth to the same name with .json
+    @return the ground truth
+    """
+    rng = random.Random(spec.seed)
+    refs = make_refs(spec, rng)
+    layout = Layout(spec.columns)
+    words_per_page = layout.chars / 6 * ((PAGE_H - 2 * MARGIN) / LINE_H) * spec.columns
+    cite_prob = min(1., spec.cites_per_page / words_per_page)
+
+    # body
+    while len(layout.pages) <= spec.pages:
+        tokens: list[tuple[str, str|None]] = []
+        for _ in range(rng.randint(40, 90)):
+            tokens.append((rng.choice(WORDS), None))
+            if refs and rng.random() < cite_prob:
+                ref = rng.choice(refs)
+                tokens.append((cite_text(ref, spec.style), ref.key))
+        tokens[-1] = (tokens[-1][0] + '.', tokens[-1][1]) if tokens[-1][1] is None else tokens[-1]
+        layout.place(wrap(tokens, layout.chars))
+    layout.pages[-1].clear() # the paragraph overflowing into page `spec.pages` is dropped
+    layout.col, layout.y = 0, PAGE_H - MARGIN - FONT_SIZE
+
+    # references
+    layout.place([_Line("References")])
+    ref_pos: dict[str, tuple[int, float, float]] = {}
+    for ref in refs:
+        text = bib_text(ref, spec.style, rng)
+        tokens = [(w, None) for w in text.split()]
+        page, x, y = layout.place(wrap(tokens, layout.chars), keep_together=True)
+        ref.page = page
+        ref_pos[ref.key] = (page, x, y + FONT_SIZE)
+
+    # write
+    writer = PDFWriter()
+    catalog = writer.reserve()
+    pages_id = writer.reserve()
+    font = writer.add("<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>")
+    page_ids = [writer.reserve() for _ in layout.pages]
+    cites: list[CiteTruth] = []
+    for page_idx, (page_id, lines) in enumerate(zip(page_ids, layout.pages)):
+        content = []
+        annots = []
+        for x, y, line in lines:
+            content.append(f"BT /F1 {FONT_SIZE} Tf 1 0 0 1 {x:.2f} {y:.2f} Tm ({_escape(line.text)}) Tj ET")
+            for offset, text, key in line.cites:
+                rect = (x + offset * CHAR_W, y - 1, x + (offset + len(text)) * CHAR_W, y + FONT_SIZE - 2)
+                cites.append(CiteTruth(page_idx, rect, text, key))
+                if spec.links == 'none':
+                    continue
+                if spec.links == 'named':
+                    dest = f"/A << /S /GoTo /D (cite.{key}) >>"
+                else:
+                    tp, tx, ty = ref_pos[key]
+                    dest = f"/Dest [{page_ids[tp]} 0 R /XYZ {tx:.2f} {ty:.2f} null]"
+                annots.append(writer.add(
+                    f"<< /Type /Annot /Subtype /Link /Rect [{' '.join(f'{v:.2f}' for v in rect)}] /Border [0 0 0] {dest} >>"
+                ))
+        stream = writer.stream('\n'.join(content))
+        annots_str = f" /Annots [{' '.join(f'{a} 0 R' for a in annots)}]" if annots else ''
+        writer.set(page_id, (
+            f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 {PAGE_W} {PAGE_H}] "
+            f"/Resources << /Font << /F1 {font} 0 R >> >> /Contents {stream} 0 R{annots_str} >>"
+        ))
+    writer.set(pages_id, f"<< /Type /Pages /Kids [{' '.join(f'{p} 0 R' for p in page_ids)}] /Count {len(page_ids)} >>")
+    names = ''
+    if spec.links == 'named':
+        entries = []
+        for key in sorted(ref_pos):
+            tp, tx, ty = ref_pos[key]
+            entries.append(f"(cite.{key}) [{page_ids[tp]} 0 R /XYZ {tx:.2f} {ty:.2f} null]")
+        dests = writer.add(f"<< /Names [{' '.join(entries)}] >>")
+        names = f" /Names << /Dests {dests} 0 R >>"
+    writer.set(catalog, f"<< /Type /Catalog /Pages {pages_id} 0 R{names} >>")
+    writer.write(path, catalog)
+
+    truth = {
+        'spec': asdict(spec),
+        'pages': len(layout.pages),
+        'bibitems': [asdict(ref) for ref in refs],
+        'citations': [asdict(cite) for cite in cites],
+    }
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(truth, f, indent=4)
+    return truth
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="generate a synthetic PDF corpus with ground truth")
+    parser.add_argument('--out', default='synthetic_pdf')
+    parser.add_argument('--pages', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--refs', type=int, nargs='+', default=[40])
+    parser.add_argument('--cites-per-page', type=int, default=12)
+    parser.add_argument('--columns', type=int, choices=[1, 2], default=2)
+    parser.add_argument('--links', choices=['named', 'explicit', 'none'], default='named')
+    parser.add_argument('--style', choices=['numbered', 'author_year'], default='numbered')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    for pages in args.pages:
+        for refs in args.refs:
+            spec = CorpusSpec(pages, args.columns, refs, args.cites_per_page, args.links, args.style, args.seed)
+            name = f"syn_{args.style}_{args.links}_c{args.columns}_p{pages}_r{refs}_s{args.seed}"
+            truth = generate(spec, os.path.join(args.out, f"{name}.pdf"))
+            print(f"{name}: {truth['pages']} pages, {len(truth['citations'])} citations, {len(truth['bibitems'])} bibitems")
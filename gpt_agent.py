@@ -1,3 +1,8 @@
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import Future
+
 from langchain.llms import OpenAI
 
 from langchain.chat_models import ChatOpenAI
@@ -7,14 +12,122 @@ from langchain.schema import (
     SystemMessage,
 )
 
+from typing import Callable
+
+class ResponseCache:
+    """
+    disk-backed cache of LLM responses keyed by (model, temperature, prompt hash)
+    concurrent calls with the same key share one request
+    only temperature=0 calls are cached unless `deterministic_only` is False
+    """
+    def __init__(self, path: str = 'llm_cache.db', deterministic_only: bool = True) -> None:
+        self.path = path
+        self.deterministic_only = deterministic_only
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS response ("
+            "key TEXT PRIMARY KEY, model TEXT, temperature REAL, prompt TEXT, response TEXT)"
+        )
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.inflight: dict[str, Future] = {}
+        self.stats = {'hits': 0, 'misses': 0, 'shared': 0, 'bypassed': 0}
+
+    @staticmethod
+    def key(model: str, temperature: float, prompt: str) -> str:
+        digest = hashlib.sha256(prompt.encode()).hexdigest()
+        return f"{model}|{float(temperature)}|{digest}"
+
+    def get(self, key: str) -> str|None:
+        with self.lock:
+            row = self.db.execute("SELECT response FROM response WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, model: str, temperature: float, prompt: str, response: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)",
+                (key, model, float(temperature), prompt, response),
+            )
+            self.db.commit()
+
+    def call(self, model: str, temperature: float, prompt: str, fn: Callable[[], str]) -> str:
+        """
+        return the cached response, or call `fn` once for all concurrent callers of the same prompt
+        """
+        if self.deterministic_only and temperature != 0:
+            with self.lock:
+                self.stats['bypassed'] += 1
+            return fn()
+        key = self.key(model, temperature, prompt)
+        with self.lock:
+            row = self.db.execute("SELECT response FROM response WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.stats['hits'] += 1
+                return row[0]
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+                self.stats['misses'] += 1
+            else:
+                self.stats['shared'] += 1
+        assert future is not None
+        if not owner:
+            return future.result()
+        try:
+            res = fn()
+            self.put(key, model, temperature, prompt, res)
+            future.set_result(res)
+            return res
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def invalidate(self, model: str = None, prompt: str = None) -> int:
+        """
+        drop cached responses of a model and/or a prompt, everything if both are None
+        @return number of dropped responses
+        """
+        conds, params = [], []
+        if model is not None:
+            conds.append("model = ?")
+            params.append(model)
+        if prompt is not None:
+            conds.append("key LIKE ?")
+            params.append(f"%|{hashlib.sha256(prompt.encode()).hexdigest()}")
+        where = f" WHERE {' AND '.join(conds)}" if conds else ""
+        with self.lock:
+            cur = self.db.execute(f"DELETE FROM response{where}", params)
+            self.db.commit()
+        return cur.rowcount
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM response").fetchone()[0]
+
 class DavinciAgent:
-    def __init__(self, temperature=0.9) -> None:
-        self.llm = OpenAI(temperature=temperature)
+    def __init__(self, temperature=0.9, cache: ResponseCache = None, **kwargs) -> None:
+        # kwargs go to langchain, e.g. openai_api_base for a local endpoint
+        self.llm = OpenAI(temperature=temperature, **kwargs)
+        self.temperature = temperature
+        self.cache = cache
     def predict(self, text: str) -> str:
-        return self.llm.predict(text)
-    
+        if self.cache is None:
+            return self.llm.predict(text)
+        return self.cache.call(self.llm.model_name, self.temperature, text, lambda: self.llm.predict(text))
+
 class GPTAgent:
-    def __init__(self, temperature=0) -> None:
-        self.chat = ChatOpenAI(temperature=temperature, model="gpt-3.5-turbo")
+    def __init__(self, temperature=0, cache: ResponseCache = None, **kwargs) -> None:
+        self.chat = ChatOpenAI(temperature=temperature, model="gpt-3.5-turbo", **kwargs)
+        self.temperature = temperature
+        self.cache = cache
     def predict(self, text: str) -> str:
-        return self.chat.predict_messages([HumanMessage(content=text)]).content
\ No newline at end of file
+        if self.cache is None:
+            return self._predict(text)
+        return self.cache.call(self.chat.model_name, self.temperature, text, lambda: self._predict(text))
+    def _predict(self, text: str) -> str:
+        return self.chat.predict_messages([HumanMessage(content=text)]).content
@@ -1,11 +1,14 @@
 import re
 import glob
+from bisect import bisect_left, bisect_right
+from loguru import logger
 
 from pylatexenc.latexwalker import LatexWalker
 from pylatexenc.latexwalker import LatexMacroNode, LatexNode, LatexEnvironmentNode, LatexNodeList, LatexGroupNode
 from pylatexenc.latex2text import LatexNodes2Text
 
-from gpt_agent import GPTAgent, DavinciAgent
+from gpt_agent import GPTAgent, DavinciAgent, ResponseCache
+from stance import classify_stances_batched
 
 class Bibitem:
     def __init__(self, key: str = "", s: str = "") -> None:
@@ -61,34 +64,115 @@ class Citation:
 {self.display_bibitems()}
 """
 
-def get_citations(doc: str) -> list[Citation]:
+class SentenceIndex:
+    """
+    sentence boundaries of the whole document, computed once
+    a context starts right after a whitespace run following ". ? !",
+    or after a "}" on a line with an earlier \\begin{ or \\end{;
+    it ends at ". ? !" followed by whitespace or "}", or at \\begin / \\end
+    """
+    end_flag = re.compile(r"(\.|\?|!)(\s|})+|\\(begin|end)")
+    punct_space = re.compile(r"[.?!](\s+)")
+    env_line = re.compile(r"\\(begin|end){[^\n]*}")
+
+    def __init__(self, doc: str) -> None:
+        self.doc = doc
+        self.ends = [m.start() for m in self.end_flag.finditer(doc)]
+        # whitespace runs after punctuation, [start, end)
+        runs = [m.span(1) for m in self.punct_space.finditer(doc)]
+        self.run_starts = [s for s, _ in runs]
+        self.run_ends = [e for _, e in runs]
+        # "}" closing an environment-like group on its line
+        self.braces: list[int] = []
+        for m in self.env_line.finditer(doc):
+            first = doc.index("{", m.start())
+            self.braces.extend(i for i in range(first + 1, m.end()) if doc[i] == "}")
+
+    def context_span(self, start: int, end: int) -> tuple[int, int]:
+        """
+        @return [start, end) of the sentence around doc[start: end]
+        """
+        last = start - 1 # last position allowed to be a boundary
+        context_start = 0
+        i = bisect_right(self.run_starts, last) - 1
+        if i >= 0:
+            context_start = min(self.run_ends[i] - 1, last) + 1
+        j = bisect_right(self.braces, last) - 1
+        if j >= 0:
+            context_start = max(context_start, self.braces[j] + 1)
+        k = bisect_left(self.ends, end)
+        context_end = self.ends[k] if k < len(self.ends) else len(self.doc)
+        return context_start, context_end
+
+class ContextConverter:
+    """
+    LaTeX to text for citation contexts, one instance per document
+    citations in the same sentence share a single conversion of the span:
+    every \\cite inside it is replaced by a marker first,
+    and the markers are substituted for each citation afterwards
+    """
+    marker = "##CITE%d##"
+    other_cite = "<cit.>" # how latex2text renders \\cite{...}
+
+    def __init__(self, converter: LatexNodes2Text = None) -> None:
+        self.converter = converter or LatexNodes2Text()
+        self.spans: dict[tuple[int, int], str|None] = {} # None if markers did not survive
+        self.cite_texts: dict[str, str] = {}
+
+    def to_text(self, latex: str) -> str:
+        try:
+            return self.converter.latex_to_text(latex)
+        except Exception as e:
+            logger.warning(f"Cannot convert LaTeX, keeping it raw: {e!r}")
+            return latex
+
+    def span_text(self, doc: str, span: tuple[int, int], inside: list[re.Match]) -> str|None:
+        if span not in self.spans:
+            start_pos, end_pos = span
+            pieces, last = [], start_pos
+            for j, m in enumerate(inside):
+                pieces.append(doc[last: m.start()])
+                pieces.append(self.marker % j)
+                last = m.end()
+            pieces.append(doc[last: end_pos])
+            text = self.to_text("".join(pieces) + ".")
+            if any(text.count(self.marker % j) != 1 for j in range(len(inside))):
+                text = None
+            self.spans[span] = text
+        return self.spans[span]
+
+    def cite_text(self, keys: str) -> str:
+        if keys not in self.cite_texts:
+            self.cite_texts[keys] = self.to_text(f"##CITE[ {keys} ]")
+        return self.cite_texts[keys]
+
+def get_citations(doc: str, converter: LatexNodes2Text = None) -> list[Citation]:
     p = re.compile(r"\\(cite|citep|citet){(.*?)}")
-    sentence_flag = re.compile(r"((\.|\?|!)(\s|})+)|\\(begin|end)")
-    sentence_flag_inv = re.compile(r"(\s+(\.|\?|!))|}.*?{(nigeb|dne)\\")
-    doc_inv = doc[::-1]
+    index = SentenceIndex(doc)
+    contexts = ContextConverter(converter)
+    matches = list(p.finditer(doc))
+    starts = [m.start() for m in matches]
     citations: list[Citation] = []
-    for m in p.finditer(doc):
-        context_start = re.search(sentence_flag_inv, doc_inv[len(doc) - m.start() - 1:])
-        context_end = re.search(sentence_flag, doc[m.end():])
-        if context_start is None or context_end is None:
-            breakpoint()
-        start_pos = m.start() - context_start.start() + 1
-        end_pos = m.end() + context_end.start()
+    for m in matches:
+        start_pos, end_pos = index.context_span(m.start(), m.end())
         context_latex = doc[start_pos: end_pos]
         
         # context_latex = re.sub(m, f"##CITE[ {m.group(2)} ]", context_latex)
         context_latex = f"{context_latex[: m.start() - start_pos]}##CITE[ {m.group(2)} ]{context_latex[m.end() - start_pos:]}."
         
-        try:
-            text = LatexNodes2Text().latex_to_text(context_latex)
-            # print(text)
-        except Exception as e:
-            print(e)
-            breakpoint()
-            text = context_latex
+        # all citations lying inside the span
+        inside = matches[bisect_left(starts, start_pos): bisect_left(starts, end_pos)]
+        inside = [mm for mm in inside if mm.end() <= end_pos]
+        text = contexts.span_text(doc, (start_pos, end_pos), inside)
+        if text is None:
+            text = contexts.to_text(context_latex)
+        else:
+            for j, mm in enumerate(inside):
+                sub = contexts.cite_text(mm.group(2)) if mm is m else contexts.other_cite
+                text = text.replace(contexts.marker % j, sub)
         
         text = text.strip()
-        context = Context(context_latex, text, start_pos, m.end() + context_end.start())
+        context = Context(context_latex, text, start_pos, end_pos)
         citation = Citation(m, context)
         citations.append(citation)
         # print(str(citation), end="\n\n")
@@ -103,14 +187,42 @@ def search_thebibliography(node: LatexNode) -> LatexEnvironmentNode|None:
                 return res
     return None
 
-def get_bibitems(doc: str) -> list[Bibitem]:
-    walker = LatexWalker(doc)
-    nodelist, pos, len_ = walker.get_latex_nodes(pos=0)
-    for node in nodelist:
-        if thebib := search_thebibliography(node):
-            break
-    else:
-        raise Exception("No thebibliography found")
+thebib_begin = re.compile(r"\\begin\s*{thebibliography}")
+thebib_end = re.compile(r"\\end\s*{thebibliography}")
+comment_pattern = re.compile(r"(?<!\\)(?:\\\\)*%") # % after an even run of backslashes, \\ is a line break
+def is_commented(doc: str, pos: int) -> bool:
+    line = doc[doc.rfind("\n", 0, pos) + 1: pos]
+    return comment_pattern.search(line) is not None
+
+def find_thebibliography(doc: str) -> tuple[int, int]|None:
+    """
+    locate the first uncommented thebibliography environment without parsing the document
+    @return [start, end) of the environment, or None
+    """
+    for begin in thebib_begin.finditer(doc):
+        if is_commented(doc, begin.start()):
+            continue
+        for end in thebib_end.finditer(doc, begin.end()):
+            if not is_commented(doc, end.start()):
+                return begin.start(), end.end()
+        return None
+    return None
+
+def get_bibitems(doc: str, converter: LatexNodes2Text = None) -> list[Bibitem]:
+    converter = converter or LatexNodes2Text()
+    thebib = None
+    # fast path: only parse the thebibliography environment
+    if span := find_thebibliography(doc):
+        nodelist, pos, len_ = LatexWalker(doc[span[0]: span[1]]).get_latex_nodes(pos=0)
+        thebib = next(filter(None, map(search_thebibliography, nodelist)), None)
+    if thebib is None:
+        walker = LatexWalker(doc)
+        nodelist, pos, len_ = walker.get_latex_nodes(pos=0)
+        for node in nodelist:
+            if thebib := search_thebibliography(node):
+                break
+        else:
+            raise Exception("No thebibliography found")
     
     thebibliography_inner_nodes: LatexNodeList = thebib.nodelist
     def is_bibitem_macro(node: LatexNode) -> bool:
@@ -130,7 +242,7 @@ def get_bibitems(doc: str) -> list[Bibitem]:
         s_nodelist = LatexNodeList(bibitem_nodelist[2:])
         # s = s_nodelist.get_content_as_chars()
         # s = s_nodelist.latex_verbatim()
-        s = LatexNodes2Text().nodelist_to_text(s_nodelist)
+        s = converter.nodelist_to_text(s_nodelist)
         bibitem = Bibitem(key, s)
         # breakpoint()
         if key in results:
@@ -151,32 +263,24 @@ if __name__ == "__main__":
     path = "data/1706.03762"
     texes = glob.glob(f"{path}/*.tex")
     doc = '\n\n'.join(f.read() for f in map(open, texes))
-    citations = get_citations(doc)
+    converter = LatexNodes2Text()
+    citations = get_citations(doc, converter)
     
-    bibitems = get_bibitems(doc)
+    bib_doc = doc
+    if find_thebibliography(doc) is None: # generated by bibtex
+        bib_doc = '\n\n'.join(f.read() for f in map(open, glob.glob(f"{path}/*.bbl")))
+    bibitems = get_bibitems(bib_doc, converter)
     assign_citations(citations, bibitems)
     
-    llm = GPTAgent()
-    prompt = """according to "%s",
-whether the author is supporting or against the cited article "%s"?
-ATTENTION: if you think he is supporting, just say "True"; if you think he is against the cited article, just say "False"; if you think he is neutral, just say "Neutral".
-"""
-    
+    cache = ResponseCache()
+    llm = GPTAgent(cache=cache)
     for i, citation in enumerate(citations):
         print(f"The {i + 1}th citation:")
         print(citation)
         print()
-        if i != 16 and i != 17:
-            continue
-        
-        
-        bibitem_str = ",".join(citation.keys)
-        question = prompt % (citation.context.text, bibitem_str)
-        
-        print(question)
-        answer = llm.predict(question)
-        answer = answer.strip()
-        print(answer)
-        print()
-        
-        # input()
\ No newline at end of file
+    
+    items = [(citation.context.text, citation.keys) for citation in citations]
+    answers = classify_stances_batched(llm, items, batch_size=10, concurrency=8, rpm=3500)
+    for i, (citation, answer) in enumerate(zip(citations, answers)):
+        print(f"The {i + 1}th citation: {','.join(citation.keys)} => {answer}")
+    print(f"LLM cache: {cache.stats}")
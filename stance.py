@@ -0,0 +1,221 @@
+"""
+concurrent stance classification of citations by LLM
+requests are issued from a thread pool, throttled by a request/token rate limiter,
+retried with exponential backoff, and returned in the input order
+"""
+import re
+import time
+import random
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from typing import Protocol
+
+STANCE_PROMPT = """according to "%s",
+whether the author is supporting or against the cited article "%s"?
+ATTENTION: if you think he is supporting, just say "True"; if you think he is against the cited article, just say "False"; if you think he is neutral, just say "Neutral".
+"""
+
+BATCH_PROMPT = """For each numbered citation context below, decide whether the author is supporting or against the cited article.
+Answer with exactly one line per item in the form "<number>: <label>", where <label> is "True" if the author is supporting, "False" if the author is against the cited article, or "Neutral" if the author is neutral. Do not output anything else.
+
+%s
+"""
+BATCH_ITEM = """[%d] context: "%s"
+cited article: "%s"
+"""
+label_pattern = re.compile(r"\b(True|False|Neutral)\b", re.I)
+batch_answer_pattern = re.compile(r"^\s*\[?(\d+)\]?\s*[:.)-]\s*\"?" + label_pattern.pattern, re.M | re.I)
+
+class Agent(Protocol):
+    def predict(self, text: str) -> str: ...
+
+def stance_question(context: str, keys: list[str]) -> str:
+    return STANCE_PROMPT % (context, ",".join(keys))
+
+def batch_question(items: list[tuple[str, list[str]]]) -> str:
+    """
+    @param items: (context, keys) of each citation
+    """
+    return BATCH_PROMPT % "\n".join(BATCH_ITEM % (i + 1, context, ",".join(keys)) for i, (context, keys) in enumerate(items))
+
+def parse_label(answer: str) -> str|None:
+    """
+    @return the label of a single answer, or None if it names no label or several
+    """
+    labels = {m.group(1).capitalize() for m in label_pattern.finditer(answer)}
+    return labels.pop() if len(labels) == 1 else None
+
+def parse_batch_answer(answer: str, n: int) -> dict[int, str]:
+    """
+    @return label of each item found in the answer, by 0-based index; items labeled twice differently are left out
+    """
+    labels: dict[int, str] = {}
+    conflicts: set[int] = set()
+    for m in batch_answer_pattern.finditer(answer):
+        idx, label = int(m.group(1)) - 1, m.group(2).capitalize()
+        if not 0 <= idx < n:
+            continue
+        if labels.setdefault(idx, label) != label:
+            conflicts.add(idx)
+    return {idx: label for idx, label in labels.items() if idx not in conflicts}
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1 # roughly 4 characters per token for English
+
+class RateLimiter:
+    """
+    token buckets for requests per minute and tokens per minute, thread-safe
+    a limit <= 0 means unlimited, `burst` is the bucket size in seconds of quota
+    """
+    def __init__(self, rpm: float = 0, tpm: float = 0, burst: float = 1.0) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_cap = max(1., rpm * burst / 60)
+        self.token_cap = max(1., tpm * burst / 60)
+        self.requests = self.request_cap
+        self.tokens = self.token_cap
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed, self.last = now - self.last, now
+        if self.rpm > 0:
+            self.requests = min(self.request_cap, self.requests + elapsed * self.rpm / 60)
+        if self.tpm > 0:
+            self.tokens = min(self.token_cap, self.tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int = 0) -> None:
+        if self.tpm > 0:
+            tokens = min(tokens, int(self.token_cap)) # a huge prompt must not wait forever
+        while True:
+            with self.lock:
+                self._refill()
+                wait = 0.
+                if self.rpm > 0 and self.requests < 1:
+                    wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+                if self.tpm > 0 and self.tokens < tokens:
+                    wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+                if wait == 0:
+                    if self.rpm > 0:
+                        self.requests -= 1
+                    if self.tpm > 0:
+                        self.tokens -= tokens
+                    return
+            time.sleep(wait)
+
+def predict_with_retry(
+        agent: Agent,
+        question: str,
+        limiter: RateLimiter,
+        retries: int = 5,
+        backoff: float = 1.0,
+) -> str|None:
+    """
+    @return the stripped answer, or None if every attempt failed
+    """
+    for attempt in range(retries + 1):
+        limiter.acquire(estimate_tokens(question))
+        try:
+            return agent.predict(question).strip()
+        except Exception as e:
+            if attempt == retries:
+                logger.error(f"Giving up after {retries + 1} attempts: {e!r}")
+                return None
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.warning(f"Attempt {attempt + 1} failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+    return None
+
+def classify_stances(
+        agent: Agent,
+        questions: list[str],
+        concurrency: int = 8,
+        rpm: float = 0,
+        tpm: float = 0,
+        retries: int = 5,
+        backoff: float = 1.0,
+) -> list[str|None]:
+    """
+    send all questions concurrently
+    @return answers in the same order as `questions`
+    """
+    limiter = RateLimiter(rpm, tpm)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(predict_with_retry, agent, q, limiter, retries, backoff) for q in questions]
+        return [f.result() for f in futures]
+
+def classify_stances_batched(
+        agent: Agent,
+        items: list[tuple[str, list[str]]],
+        batch_size: int = 10,
+        concurrency: int = 8,
+        rpm: float = 0,
+        tpm: float = 0,
+        retries: int = 5,
+        backoff: float = 1.0,
+) -> list[str|None]:
+    """
+    pack `batch_size` citations of a paper into one prompt,
+    items missing in the answer of a batch are asked one by one
+    @param items: (context, keys) of each citation
+    @return labels in the same order as `items`, None where the answer names no single label or every attempt failed
+    """
+    limiter = RateLimiter(rpm, tpm)
+    batches = [items[i: i + batch_size] for i in range(0, len(items), batch_size)]
+    def deal_batch(batch: list[tuple[str, list[str]]]) -> list[str|None]:
+        labels: dict[int, str|None] = {}
+        if len(batch) > 1:
+            answer = predict_with_retry(agent, batch_question(batch), limiter, retries, backoff)
+            if answer is not None:
+                labels.update(parse_batch_answer(answer, len(batch)))
+            if len(labels) < len(batch):
+                logger.warning(f"{len(batch) - len(labels)} of {len(batch)} citations missing in the batched answer, asking them one by one")
+        for i, item in enumerate(batch):
+            if i not in labels:
+                answer = predict_with_retry(agent, stance_question(*item), limiter, retries, backoff)
+                labels[i] = None if answer is None else parse_label(answer)
+        return [labels[i] for i in range(len(batch))]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(deal_batch, batches))
+    return [answer for answers in results for answer in answers]
+
+def bench_stub(n: int, batch_size: int, garble_rate: float) -> None:
+    """
+    compare calls and tokens of single and batched prompting on a local stub model
+    """
+    from fake_llm import StubAgent
+    items = [(f"Sentence {i} of the paper that cites ##CITE[ key{i} ] for its method.", [f"key{i}"]) for i in range(n)]
+    for name, size in (('single', 1), ('batched', batch_size)):
+        agent = StubAgent(garble_rate=garble_rate)
+        answers = classify_stances_batched(agent, items, size)
+        assert len(answers) == n
+        logger.success(f"{name}: {agent.stats['calls']} calls, {agent.stats['prompt_tokens']} prompt tokens, {agent.stats['completion_tokens']} completion tokens")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="throughput benchmark against an OpenAI-compatible endpoint")
+    parser.add_argument('--api-base', default='http://127.0.0.1:8000/v1', help="e.g. the endpoint of fake_llm.py")
+    parser.add_argument('-n', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rpm', type=float, default=0)
+    parser.add_argument('--tpm', type=float, default=0)
+    parser.add_argument('--stub', action='store_true', help="compare single and batched prompting on a local stub model")
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--garble-rate', type=float, default=0., help="chance that the stub garbles a batched answer")
+    args = parser.parse_args()
+    if args.stub:
+        bench_stub(args.n, args.batch_size, args.garble_rate)
+        raise SystemExit
+
+    from gpt_agent import GPTAgent
+    agent = GPTAgent(openai_api_base=args.api_base, openai_api_key='fake', max_retries=0)
+    questions = [stance_question(f"Sentence {i} that cites ##CITE[ key{i} ].", [f"key{i}"]) for i in range(args.n)]
+    start = time.perf_counter()
+    answers = classify_stances(agent, questions, args.concurrency, args.rpm, args.tpm)
+    elapsed = time.perf_counter() - start
+    failed = sum(a is None for a in answers)
+    logger.success(f"{args.n} requests in {elapsed:.2f}s, {args.n / elapsed:.1f} req/s, {failed} failed")
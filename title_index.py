@@ -0,0 +1,100 @@
+"""
+title lookup for citation resolution
+a text equal to a title up to case, punctuation and whitespace is found by a dict lookup,
+otherwise the titles that may reach the threshold are compared in order,
+so the result is the same as comparing the text with every title
+
+ratio(a, b) = 2 * lcs(a, b) / (la + lb), and both filters bound lcs from above:
+- lcs <= min(la, lb)
+- lcs <= the number of characters a and b have in common, counted in hash buckets
+"""
+import re
+import numpy as np
+from Levenshtein import ratio
+
+from db import PaperData
+
+from typing import Sequence
+
+Match = tuple[int, float, str] # (paper id, similarity, method)
+
+separator_pattern = re.compile(r"[\W_]+")
+n_buckets = 64 # a-z, A-Z, digits and space fall into distinct buckets
+slack = 1e-6 # keeps float rounding from filtering out a title at the threshold
+
+def normalize_title(text: str) -> str:
+    return separator_pattern.sub(' ', text.casefold()).strip()
+
+def char_codes(text: str) -> np.ndarray:
+    return np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+
+def char_counts(text: str) -> np.ndarray:
+    return np.bincount(char_codes(text) % n_buckets, minlength=n_buckets)
+
+class TitleIndex:
+    def __init__(self, ids: Sequence[int], titles: Sequence[str], threshold: float = 0.8) -> None:
+        """
+        the titles are kept concatenated in one string and the rest in numpy arrays,
+        so that workers forked after building the index share its memory
+        """
+        self.threshold = threshold
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lengths = np.array([len(title) for title in titles], dtype=np.int64)
+        self.offsets = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=self.offsets[1:])
+        self.text = ''.join(titles)
+        rows = np.repeat(np.arange(len(self.lengths)), self.lengths)
+        counts = np.bincount(rows * n_buckets + char_codes(self.text) % n_buckets, minlength=len(self.lengths) * n_buckets)
+        # rows sorted by length, so the length filter selects a slice
+        self.order = np.argsort(self.lengths, kind='stable')
+        self.sorted_lengths = self.lengths[self.order]
+        self.counts = counts.reshape(-1, n_buckets).astype(np.uint16)[self.order]
+        self.exact: dict[str, int] = {}
+        for paper_id, title in zip(ids, titles):
+            if key := normalize_title(title):
+                self.exact.setdefault(key, paper_id)
+        self.stats = {'queries': 0, 'exact': 0, 'fuzzy': 0, 'candidates': 0, 'comparisons': 0}
+
+    @classmethod
+    def from_papers(cls, papers: list[PaperData], **kwargs) -> 'TitleIndex':
+        return cls([paper.paper_id for paper in papers], [paper.paper_title for paper in papers], **kwargs)
+
+    def title(self, idx: int) -> str:
+        return self.text[self.offsets[idx]: self.offsets[idx + 1]]
+
+    def candidates(self, text: str) -> np.ndarray:
+        """
+        @return indices of the papers worth comparing, in the original order
+        """
+        la, t = len(text), self.threshold
+        lo = np.searchsorted(self.sorted_lengths, t * la / (2 - t) - 1, side='right')
+        hi = np.searchsorted(self.sorted_lengths, (2 - t) * la / t + 1, side='left')
+        lengths = self.sorted_lengths[lo: hi]
+        bound = t * (la + lengths) - slack
+        common = np.minimum(self.counts[lo: hi], char_counts(text).astype(np.uint16)).sum(axis=1)
+        keep = (la + lengths > 0) & (2 * np.minimum(la, lengths) > bound) & (2 * common > bound)
+        res = np.sort(self.order[lo: hi][keep])
+        self.stats['candidates'] += len(res)
+        return res
+
+    def match(self, text: str) -> Match|None:
+        """
+        @return (paper id, similarity, method) of the first paper whose title matches `text`, or None
+        """
+        self.stats['queries'] += 1
+        if (paper_id := self.exact.get(normalize_title(text))) is not None:
+            self.stats['exact'] += 1
+            return paper_id, 1., 'exact'
+        for idx in self.candidates(text):
+            self.stats['comparisons'] += 1
+            if (r := ratio(text, self.title(idx))) > self.threshold:
+                self.stats['fuzzy'] += 1
+                return int(self.ids[idx]), r, 'fuzzy'
+        return None
+
+    def find(self, text: str) -> int|None:
+        """
+        @return id of the first paper whose title matches `text`, or None
+        """
+        match = self.match(text)
+        return None if match is None else match[0]
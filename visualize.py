@@ -1,29 +1,46 @@
 import re
 import os
+import gc
+import argparse
 from Levenshtein import ratio
 import json
-import itertools
+import hashlib
+from collections import Counter
 
 import db
 from db import Paper, Author, PaperData
+from title_index import TitleIndex, Match
 from tqdm import tqdm
 import multiprocessing as mp
 
 label_pattern = re.compile(r"\[[\d\w]+\]")
 url_pattern = re.compile(r"(http|https)://[^\s]*")
-def find_target(bibitem: str, papers: list[PaperData]) -> int|None:
+def bibitem_sentences(bibitem: str) -> list[str]:
     bibitem = bibitem.replace("\n", " ").strip()
     bibitem = label_pattern.sub("", bibitem)
     bibitem = url_pattern.sub("", bibitem)
-    sentences = [s for s in bibitem.split(".") if len(s) > 10]
-    for sentence in sentences:
+    return [s for s in bibitem.split(".") if len(s) > 10]
+
+def match_target(bibitem: str, index: TitleIndex) -> Match|None:
+    for sentence in bibitem_sentences(bibitem):
+        if (match := index.match(sentence)) is not None:
+            return match
+    return None
+
+def find_target(bibitem: str, papers: list[PaperData], index: TitleIndex|None = None) -> int|None:
+    if index is not None:
+        match = match_target(bibitem, index)
+        return None if match is None else match[0]
+    for sentence in bibitem_sentences(bibitem):
         for paper in papers:
             r = ratio(sentence, paper.paper_title)
             if r > 0.8:
                 return paper.paper_id
     return None
 
-def find_target_by_title(title: str, papers: list[PaperData]):
+def find_target_by_title(title: str, papers: list[PaperData], index: TitleIndex|None = None):
+    if index is not None:
+        return index.find(title)
     for paper in papers:
         r = ratio(title, paper.paper_title)
         if r > 0.8:
@@ -42,56 +59,204 @@ def gen_vertex(papers: list[PaperData]) -> list[dict]:
         })
     return vertex
 
+def resolve_citation(cite: list, index: TitleIndex) -> Match|None:
+    if len(cite) > 3 and cite[3] != '':
+        return index.match(cite[3])
+    return match_target(cite[1], index)
+
 # worker function in gen_edge
-def gen_edge_deal_vertex(idx: int) -> list[dict[str, str]]:
-    global papers
-    paper = papers[idx]
+def gen_edge_deal_vertex(citations: list[list]) -> tuple[list[str], list[int], list[tuple[int, Match]], dict[str, int]]:
+    """
+    @param citations: citation list of a source paper
+    @return (targets, indices of the unresolved citations, (index, match) of the resolved ones, lookup counters)
+    """
+    index = title_index
+    assert index is not None, "gen_edge_worker_init not run"
     targets: set[str] = set()
-    for cite in paper.paper_citation[1]:
+    unresolved: list[int] = []
+    matches: list[tuple[int, Match]] = []
+    lookups = dict(index.stats)
+    stored = 0
+    for i, cite in enumerate(citations):
         if cite[2] != -1:
             targets.add(str(cite[2]))
+            stored += 1
             continue
-        if len(cite) > 3 and cite[3] != '':
-            target = find_target_by_title(cite[3], papers)
+        match = resolve_citation(cite, index)
+        if match is not None:
+            targets.add(str(match[0]))
+            matches.append((i, match))
         else:
-            target = find_target(cite[1], papers)
-        if target is not None:
-            targets.add(str(target))
-    edges = []
-    paper_id = str(paper.paper_id)
-    for target in targets:
-        edges.append({
-            'source': paper_id,
-            'target': str(target),
-        })
-    return edges
+            unresolved.append(i)
+    stats = {key: value - lookups[key] for key, value in index.stats.items()}
+    stats['stored'] = stored
+    return sorted(targets), unresolved, matches, stats
+
+# worker function in gen_edge
+def gen_edge_deal_chunk(chunk: list[list[list]]) -> list[tuple[list[str], list[int], list[tuple[int, Match]], dict[str, int]]]:
+    return [gen_edge_deal_vertex(citations) for citations in chunk]
+
+title_index: TitleIndex|None = None # built by gen_edge before forking the workers
 
 # worker init in gen_edge
-def gen_edge_worker_init(papers_):
-    global papers
-    papers = papers_
+def gen_edge_worker_init(ids: list[int], titles: list[str]):
+    """
+    forked workers inherit the index of the parent, only spawned ones build their own
+    """
+    global title_index
+    if title_index is None:
+        title_index = TitleIndex(ids, titles)
+
+def citation_hash(paper: PaperData) -> str:
+    return hashlib.sha1(json.dumps(paper.paper_citation, sort_keys=True).encode()).hexdigest()
+
+def corpus_version(titles: dict[str, str]) -> str:
+    return hashlib.sha1(json.dumps(titles, sort_keys=True).encode()).hexdigest()
 
-def gen_edge(papers: list[PaperData], V: list[dict]):
-    cache_file = f'edge_cache_{len(papers)}.json'
+def save_matches(papers: list[PaperData], matches: dict[int, list[tuple[int, Match]]]) -> None:
+    """
+    write resolved targets back to paper_citation and the citation table,
+    so that later runs take them as stored targets
+    @param matches: index in `papers` -> (index in its citations, match)
+    """
+    rows = []
+    for idx, found in matches.items():
+        paper = papers[idx]
+        cites = paper.paper_citation[1]
+        paper_rows = db.citation_rows(paper.paper_id, cites)
+        for i, (target, score, method) in found:
+            cites[i][2] = target
+            paper_rows[i].update(target_id=target, match_score=score, match_method=method)
+            rows.append(paper_rows[i])
+    res = db.update_papers((papers[idx].paper_id, 'paper_citation', papers[idx].paper_citation) for idx in matches)
+    db.save_citation_matches(rows)
+    print(f"{len(rows)} resolved citations of {res['rows']} papers saved in {res['seconds']:.1f}s")
+
+def load_edge_cache(cache_file: str) -> dict:
     if os.path.exists(cache_file):
         with open(cache_file, 'r') as f:
             return json.load(f)
-    with mp.Pool(initializer=gen_edge_worker_init, initargs=(papers,)) as p:
-        # token_list = list(tqdm(p.imap(quote2tokens, self.quotes, chunksize=chunksize), total=len(self.quotes)))
-        results = list(tqdm(p.imap(gen_edge_deal_vertex, range(len(papers))), total=len(papers)))
-    edges = list(itertools.chain.from_iterable(results))
+    return {'version': None, 'titles': {}, 'sources': {}}
+
+def recheck_entries(papers: list[PaperData], kept: list[tuple[int, dict]], added: list[PaperData], index: TitleIndex) -> None:
+    """
+    resolve again the cached citations left unresolved or resolved by title that a new title matches,
+    since a new title may come first
+    @param kept: (index in `papers`, cache entry) of the cached sources, entries are updated in place
+    @param index: index of all the titles
+    """
+    added_index = TitleIndex.from_papers(added)
+    rechecked = changed = 0
+    for idx, entry in kept:
+        cites = papers[idx].paper_citation[1]
+        matched = {m[0]: m for m in entry['matches']}
+        unresolved = []
+        for i in sorted([*entry['unresolved'], *matched]):
+            if resolve_citation(cites[i], added_index) is None: # the result among the old titles stands
+                if i not in matched:
+                    unresolved.append(i)
+                continue
+            rechecked += 1
+            match = resolve_citation(cites[i], index)
+            assert match is not None
+            if i not in matched or matched[i][1] != match[0]:
+                changed += 1
+            matched[i] = [i, *match]
+        entry['unresolved'] = unresolved
+        entry['matches'] = [matched[i] for i in sorted(matched)]
+        stored = {str(cite[2]) for cite in cites if cite[2] != -1}
+        entry['targets'] = sorted(stored | {str(m[1]) for m in entry['matches']})
+    print(f"{rechecked} cached citations matching new titles resolved again, {changed} changed")
+
+def gen_edge(papers: list[PaperData], V: list[dict], cache_file: str = 'edge_cache.json', chunk_size: int = 64, persist: bool = False):
+    """
+    targets are cached per source paper with the hash of its citations,
+    only new or changed papers and papers citing a removed or renamed title are resolved again,
+    cached citations left unresolved or resolved by title are looked up again only if a title added since matches them
+    the index of all titles is built before forking the workers, which share it and only get the citations of their chunk
+    every entry keeps the (index, target, score, method) of its title-matched citations
+    @param persist: save the title-matched targets not in the database yet, cached ones included
+    """
+    global title_index
+    cache = load_edge_cache(cache_file)
+    titles = {str(paper.paper_id): paper.paper_title for paper in papers}
+    version = corpus_version(titles)
+    added: list[PaperData] = []
+    gone: set[str] = set()
+    if cache['version'] != version: # same titles as the cache, nothing to diff
+        added = [paper for paper in papers if cache['titles'].get(str(paper.paper_id)) != paper.paper_title]
+        gone = {paper_id for paper_id, title in cache['titles'].items() if titles.get(paper_id) != title}
+
+    sources: dict[str, dict] = {}
+    todo: list[int] = []
+    kept: list[tuple[int, dict]] = []
+    for idx, paper in enumerate(papers):
+        entry = cache['sources'].get(str(paper.paper_id))
+        if (entry is None or 'matches' not in entry # entries of older caches lack the matches
+                or entry['hash'] != citation_hash(paper) or gone.intersection(entry['targets'])):
+            todo.append(idx)
+        else:
+            kept.append((idx, entry))
+    print(f"{len(kept)} cached sources, {len(todo)} to resolve, {len(added)} new titles")
+
+    corpus = ([paper.paper_id for paper in papers], [paper.paper_title for paper in papers])
+    if todo or added:
+        title_index = TitleIndex(*corpus)
+        if kept and added:
+            recheck_entries(papers, kept, added, title_index)
+    for idx, entry in kept:
+        sources[str(papers[idx].paper_id)] = entry
+
+    if todo:
+        chunks = [todo[i: i + chunk_size] for i in range(0, len(todo), chunk_size)]
+        tasks = ([papers[idx].paper_citation[1] for idx in chunk] for chunk in chunks)
+        stats: Counter[str] = Counter()
+        gc.freeze() # keeps the collector of the workers from copying the pages of the parent
+        with mp.Pool(initializer=gen_edge_worker_init, initargs=corpus) as p:
+            for chunk, results in zip(chunks, tqdm(p.imap(gen_edge_deal_chunk, tasks), total=len(chunks))):
+                for idx, (targets, unresolved, found, counts) in zip(chunk, results):
+                    paper = papers[idx]
+                    sources[str(paper.paper_id)] = {
+                        'hash': citation_hash(paper),
+                        'targets': targets,
+                        'unresolved': unresolved,
+                        'matches': [[i, *match] for i, match in found],
+                    }
+                    stats.update(counts)
+        gc.unfreeze()
+        queries = max(stats['queries'], 1)
+        print(f"{stats['stored']} stored targets, {stats['queries']} title lookups: "
+              f"{stats['exact'] / queries:.1%} exact, {stats['fuzzy'] / queries:.1%} fuzzy, "
+              f"{stats['comparisons']} Levenshtein comparisons")
+
+    if persist:
+        matches: dict[int, list[tuple[int, Match]]] = {}
+        for idx, paper in enumerate(papers):
+            cites = paper.paper_citation[1]
+            found = [(i, (target, score, method)) for i, target, score, method in sources[str(paper.paper_id)]['matches'] if cites[i][2] == -1]
+            if found:
+                matches[idx] = found
+        if matches:
+            save_matches(papers, matches)
+            for idx in matches: # the citations now carry the targets
+                sources[str(papers[idx].paper_id)]['hash'] = citation_hash(papers[idx])
+
     with open(cache_file, 'w') as f:
-        json.dump(edges, f, indent=4)
-    return edges
+        json.dump({'version': version, 'titles': titles, 'sources': sources}, f)
+    return [{'source': paper_id, 'target': target} for paper_id in titles for target in sources[paper_id]['targets']]
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="export the citation graph to visualize.html")
+    parser.add_argument('--persist', action='store_true', help="save the title-matched targets to the database")
+    args = parser.parse_args()
+
     db.init_engine('sqlite:///../phocus/database.db')
-    papers = db.select_paper_all()
-    papers = [PaperData.from_Paper(paper) for paper in papers if paper.paper_citation.startswith("[true")]
+    columns = ('paper_title', 'author_list', 'paper_citation')
+    papers = list(db.iter_valid_paper_data(columns))
     
     V = gen_vertex(papers)
     print(f"{len(V)} valid papers")
-    E = gen_edge(papers, V)
+    E = gen_edge(papers, V, persist=args.persist)
     print(f"{len(E)} valid references")
     
     data = json.dumps({